@@ -0,0 +1,200 @@
+"""
+Benchmarks for the Harmonizer hot paths.
+
+    python benchmark.py [--json results.json] [--compare baseline.json]
+
+Every case is run for a fixed duration and reports its throughput over
+batches of calls, latency percentiles over individually timed calls and
+the peak memory allocated by one call.
+With --compare, cases whose throughput dropped by more than the threshold
+against a stored baseline are flagged and the exit status is 1.
+"""
+import argparse
+import json
+import platform
+import re
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from harmony import Harmonizer
+
+# Tension names appended to the base chord names of extended chord labels.
+TENSIONS = {"b9", "9", "#9", "b11", "11", "#11", "b13", "13", "#13"}
+
+
+def chord_family(label):
+    """
+    :param label: chord label, e.g. "C/E 7(b5,9)"
+    :return: (base chord name, inverted), e.g. ("7(b5)", True)
+    """
+    head, suffix = re.match(r"([A-G][b#]*(?:/[A-G][b#]*)?) ?(.*)", label).groups()
+    if suffix.endswith(")"):
+        base, _, names = suffix[:-1].rpartition("(")
+        kept = [n for n in names.split(",") if n not in TENSIONS]
+        suffix = base + ("(%s)" % ",".join(kept) if kept else "")
+
+    return suffix, "/" in head
+
+
+def chord_voicings():
+    """
+    Find, over C, one voicing of every chord family known to the chord
+    index for each number of notes from 3 to 7, in root position and in
+    inversion, plus a miss.
+
+    :return: list of (label, intervals)
+    """
+    h = Harmonizer()
+
+    found = {}
+    for mask in range(1, 1 << 12, 2):
+        notes = [i for i in range(12) if mask >> i & 1]
+        if not 3 <= len(notes) <= 7:
+            continue
+        for voicing in (notes, notes[1:] + notes[:1]):
+            label = h.check_chord("C", voicing)
+            if label == "NA":
+                continue
+            found.setdefault(chord_family(label) + (len(notes),), (label, voicing))
+    found[None] = ("NA", [0, 1, 2, 3])
+
+    return sorted(found.values())
+
+
+def cases():
+    """
+    :return: list of (name, function) pairs to benchmark
+    """
+    h = Harmonizer(root="C", mode="major")
+    modes = list(h.modes())
+
+    out = [
+        ("init", lambda: Harmonizer(root="D", mode="dorian")),
+        ("get", lambda: Harmonizer.get(root="D", mode="dorian")),
+        ("get_scale", h.get_scale),
+        ("get_intervals", h.get_intervals),
+    ]
+
+    for label, x in chord_voicings():
+        out.append(("check_chord[%s]" % label, lambda x=x: h.check_chord("C", x)))
+
+    def harmonize_cold(m):
+        Harmonizer.clear_cache()
+        m.harmonize()
+
+    for mode in modes:
+        m = Harmonizer(root="C", mode=mode)
+        out.append(("harmonize[%s]" % mode, m.harmonize))
+        out.append(("harmonize_cold[%s]" % mode, lambda m=m: harmonize_cold(m)))
+
+    return out
+
+
+def measure(fn, duration=0.2, batch=100):
+    """
+    Benchmark one function. Throughput is measured over batches of calls,
+    latency percentiles over individually timed calls, which include the
+    overhead of reading the clock.
+
+    :param fn: function to call without arguments
+    :param duration: seconds spent timing each of throughput and latency
+    :param batch: calls per timed batch
+    :return: dict of ops_per_sec, p50_us, p90_us, p99_us and peak_bytes
+    """
+    clock = time.perf_counter
+    for _ in range(batch):
+        fn()
+
+    calls = 0
+    elapsed = 0.0
+    while elapsed < duration:
+        t = clock()
+        for _ in range(batch):
+            fn()
+        elapsed += clock() - t
+        calls += batch
+
+    samples = []
+    start = clock()
+    while clock() - start < duration:
+        for _ in range(batch):
+            t = clock()
+            fn()
+            samples.append(clock() - t)
+
+    tracemalloc.start()
+    peak = 0
+    for _ in range(10):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        fn()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    p50, p90, p99 = np.percentile(samples, [50, 90, 99]) * 1e6
+    return {
+        "ops_per_sec": calls / elapsed,
+        "p50_us": p50,
+        "p90_us": p90,
+        "p99_us": p99,
+        "peak_bytes": peak,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    :param results: benchmark results by case name
+    :param baseline: stored results by case name
+    :param threshold: tolerated relative throughput drop
+    :return: list of (name, baseline ops/sec, current ops/sec) regressions
+    """
+    regressions = []
+    for name, r in results.items():
+        b = baseline.get(name)
+        if b and r["ops_per_sec"] < b["ops_per_sec"] * (1 - threshold):
+            regressions.append((name, b["ops_per_sec"], r["ops_per_sec"]))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Harmonizer hot paths.")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="baseline results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="tolerated throughput drop (default: 0.1)")
+    parser.add_argument("--duration", type=float, default=0.2, help="seconds per case (default: 0.2)")
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this text")
+    args = parser.parse_args(argv)
+
+    results = {}
+    print("%-40s %14s %10s %10s %10s %10s" % ("case", "ops/sec", "p50 us", "p90 us", "p99 us", "peak B"))
+    for name, fn in cases():
+        if args.filter not in name:
+            continue
+        r = results[name] = measure(fn, duration=args.duration)
+        print("%-40s %14.0f %10.2f %10.2f %10.2f %10d"
+              % (name, r["ops_per_sec"], r["p50_us"], r["p90_us"], r["p99_us"], r["peak_bytes"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": platform.python_version(), "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after in regressions:
+            print("REGRESSION %s: %.0f -> %.0f ops/sec (%.1f%%)"
+                  % (name, before, after, 100 * (after - before) / before))
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,388 @@
-import numpy as np
+import csv
+import functools
+import hashlib
+import importlib
+import itertools
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+from urllib.parse import parse_qs
+
+
+class _LazyModule():
+    """
+    Stand-in for a module imported on first attribute access, after which
+    the real module replaces it in the module globals.
+    """
+
+    def __init__(self, name, alias):
+        self.__name = name
+        self.__alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name)
+        globals()[self.__alias] = module
+        return getattr(module, attr)
+
+
+# NumPy and asyncio weigh most of the import time and are only needed by
+# the batch, MIDI and server features, not by scale and chord lookups.
+np = _LazyModule("numpy", "np")
+asyncio = _LazyModule("asyncio", "asyncio")
+
+
+_NOTES = ["C", "Db", "D", "Eb", "E", "F",
+          "Gb", "G", "Ab", "A", "Bb", "B"]
+_SHARP_NOTES = ["C", "C#", "D", "D#", "E", "F",
+                "F#", "G", "G#", "A", "A#", "B"]
+
+_LETTERS = "CDEFGAB"
+_NATURALS = [0, 2, 4, 5, 7, 9, 11]
+_ACCIDENTALS = {-2: "bb", -1: "b", 0: "", 1: "#", 2: "##"}
+
+# Every accepted note spelling mapped to its pitch class.
+_SPELLINGS = {letter + acc: (n + shift) % 12
+              for letter, n in zip(_LETTERS, _NATURALS)
+              for shift, acc in _ACCIDENTALS.items()}
+
+# Every accepted note token mapped to its MIDI number: spellings with an
+# octave (C4 = 60) and MIDI numbers, as int or str.
+_MIDI_NUMBERS = {letter + acc + str(octave): 12 * (octave + 1) + n + shift
+                 for letter, n in zip(_LETTERS, _NATURALS)
+                 for shift, acc in _ACCIDENTALS.items()
+                 for octave in range(-1, 10)
+                 if 0 <= 12 * (octave + 1) + n + shift < 128}
+_MIDI_NUMBERS.update((n, n) for n in range(128))
+_MIDI_NUMBERS.update((str(n), n) for n in range(128))
+
+# Every accepted note token mapped to its pitch class.
+_PITCH_CLASSES = {token: n % 12 for token, n in _MIDI_NUMBERS.items()}
+_PITCH_CLASSES.update(_SPELLINGS)
+
+# Header of the lookup tables files written by Harmonizer.save_tables.
+_TABLES_MAGIC = b"HARMONYT"
+_TABLES_VERSION = 4
+
+# Labels historically written without a space between the chord name and the
+# quality, for the root position and for the inversions respectively.
+_UNSPACED_ROOT = {"6"}
+_UNSPACED_INVERSION = {"6", "min7", "min6"}
+
+
+def parse_pitch(token):
+    """
+    Read a pitch with octave as a MIDI number.
+
+    :param token: spelling with octave such as "C#4" or "Bbb3" (C4 = 60), or
+        a MIDI number as int or str
+    :return: MIDI note number
+    """
+    try:
+        return _MIDI_NUMBERS[token]
+    except (KeyError, TypeError):
+        raise ValueError("unknown pitch: %r" % (token,))
+
+
+def _spell_scale(root, intervals):
+    """
+    Spell a scale from a root spelling, giving each degree of a seven-note
+    scale its own letter. Degrees that would need more than two accidentals,
+    and scales of other sizes, fall back to the sharp or flat name matching
+    the root.
+
+    :param root: root spelling
+    :param intervals: semitones above the root, in scale order
+    :return: list of note names
+    """
+    base = _SPELLINGS[root]
+    names = _SHARP_NOTES if "#" in root else _NOTES
+    if len(intervals) != 7:
+        return [names[(base + i) % 12] for i in intervals]
+
+    letter = _LETTERS.index(root[0])
+    ranks = sorted(intervals)
+    out = []
+    for i in intervals:
+        degree = (letter + ranks.index(i)) % 7
+        shift = (base + i - _NATURALS[degree] + 6) % 12 - 6
+        if shift in _ACCIDENTALS:
+            out.append(_LETTERS[degree] + _ACCIDENTALS[shift])
+        else:
+            out.append(names[(base + i) % 12])
+
+    return out
+
+
+def _chord_key(x):
+    """
+    Encode a voicing as an integer lookup key: the 12-bit pitch-class set of
+    the intervals, with the bass interval stored in the bits above it.
+
+    :param x: intervals from the chord root, bass first
+    :return: lookup key
+    """
+    mask = 0
+    for i in x:
+        mask |= 1 << (i % 12)
+
+    return (x[0] % 12) << 12 | mask
+
+
+def _chord_label(root, bass, suffix):
+    """
+    Spell a chord label from a voicing index entry.
+
+    :param root: chord root name, whose spelling is kept; the bass is
+        spelled with sharps if it has a sharp, with flats otherwise
+    :param bass: bass interval above the root
+    :param suffix: label suffix
+    :return: chord label
+    """
+    if bass == 0:
+        return root + suffix
+
+    names = _SHARP_NOTES if "#" in root else _NOTES
+    return root + "/" + names[(_SPELLINGS[root] + bass) % 12] + suffix
+
+
+_ROMAN = ["I", "II", "III", "IV", "V", "VI", "VII", "VIII", "IX", "X", "XI", "XII"]
+
+# Harmonic function by interval above the tonic, for scales other than
+# seven-note ones whose functions follow the degree.
+_FUNCTIONS = ["tonic", "subdominant", "subdominant", "tonic", "tonic", "subdominant",
+              "subdominant", "dominant", "tonic", "tonic", "dominant", "dominant"]
+_HEPTATONIC_FUNCTIONS = ["tonic", "subdominant", "tonic", "subdominant", "dominant", "tonic", "dominant"]
+
+
+def _roman_numeral(accidental, degree, rel):
+    """
+    Write a Roman numeral for a chord on a scale degree: upper case unless
+    the third is minor, then the triad and seventh figures. Tensions and
+    inversions are not shown.
+
+    :param accidental: "", "b" or "#" before the numeral
+    :param degree: scale degree, counted from 0
+    :param rel: pitch-class set of the chord relative to its root
+    :return: Roman numeral
+    """
+    def has(*intervals):
+        return all(rel >> i & 1 for i in intervals)
+
+    numeral = _ROMAN[degree]
+    minor = has(3) and not has(4)
+    if minor:
+        numeral = numeral.lower()
+
+    if minor and has(6) and not has(7):
+        if has(10):
+            return accidental + numeral + "ø7"
+        return accidental + numeral + ("°7" if has(9) else "°")
+    if has(4, 8) and not has(7):
+        numeral += "+"
+
+    if has(11):
+        numeral += "maj7"
+    elif has(10):
+        numeral += "7"
+
+    return accidental + numeral
+
+
+def _extend_chords(chords, tensions):
+    """
+    Generate extended chords by stacking tensions over base chords: one
+    choice of ninth, then also one of eleventh, then also one of thirteenth.
+    Tensions doubling a note of the base chord are skipped.
+
+    :param chords: list of (quality, intervals) base chords
+    :param tensions: list, by extension, of (name, interval) choices
+    :return: list of (quality, intervals) extended chords
+    """
+    extended = []
+    for depth in range(1, len(tensions) + 1):
+        for stack in itertools.product(*tensions[:depth]):
+            for quality, intervals in chords:
+                if any(i in intervals for _, i in stack):
+                    continue
+                names = ",".join(name for name, _ in stack)
+                if quality.endswith(")") and quality[quality.rindex("(") + 1] in "b#0123456789":
+                    quality = quality[:-1] + "," + names + ")"
+                else:
+                    quality = quality + "(" + names + ")"
+                extended.append((quality, intervals + [i for _, i in stack]))
+
+    return extended
+
+
+def _build_chord_index(chords):
+    """
+    Build the voicing lookup table for a chord vocabulary.
+
+    Every rotation of every chord is registered under its key; the first
+    chord claiming a key wins, so the vocabulary order sets the priority.
+
+    :param chords: list of (quality, intervals) pairs
+    :return: dict mapping a voicing key to (bass interval, label suffix)
+    """
+    index = {}
+    for quality, intervals in chords:
+        for i in range(len(intervals)):
+            voicing = intervals[i:] + intervals[:i]
+            if i == 0:
+                suffix = quality if quality in _UNSPACED_ROOT else " " + quality
+            else:
+                suffix = quality if quality in _UNSPACED_INVERSION else " " + quality
+            index.setdefault(_chord_key(voicing), (voicing[0], suffix))
+
+    return index
+
+
+def _csr_append(offsets, values, keys, rows):
+    """
+    Append rows to a table in compressed sparse row form, after the rows
+    already stored under the same keys.
+
+    :param offsets: start of the rows of every key, plus the end
+    :param values: rows of every key, in key order
+    :param keys: key of every new row
+    :param rows: new rows
+    :return: new (offsets, values) pair
+    """
+    keys = np.asarray(keys, dtype=np.intp)
+    rows = np.asarray(rows, dtype=values.dtype).reshape((len(keys),) + values.shape[1:])
+    order = np.argsort(keys, kind="stable")
+    keys, rows = keys[order], rows[order]
+
+    values = np.insert(values, offsets[keys + 1], rows, axis=0)
+    counts = np.bincount(keys, minlength=len(offsets) - 1)
+    offsets = offsets + np.concatenate(([0], np.cumsum(counts))).astype(offsets.dtype)
+
+    return offsets, values
+
+
+class Metrics():
+    """
+    Call counts and latencies of the Harmonizer entry points, hit rates of
+    the shared memo by result kind and rates of unrecognized ("NA") chord
+    labels, as recorded while enabled with Harmonizer.enable_metrics.
+    Latency percentiles are computed over the most recent calls only.
+    """
+
+    __quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, samples=10000):
+        self.samples = samples
+        self.__lock = threading.Lock()
+        self.__calls = {}
+        self.__memo = {}
+        self.__labels = {}
+
+    def record_call(self, method, seconds):
+        """
+        :param method: entry point name
+        :param seconds: duration of the call
+        """
+        with self.__lock:
+            stats = self.__calls.get(method)
+            if stats is None:
+                stats = self.__calls[method] = [0, 0.0, deque(maxlen=self.samples)]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2].append(seconds)
+
+    def record_memo(self, kind, hit):
+        """
+        :param kind: memo result kind
+        :param hit: whether the result was already memoized
+        """
+        with self.__lock:
+            stats = self.__memo.setdefault(kind, [0, 0])
+            stats[0 if hit else 1] += 1
+
+    def record_labels(self, method, count, na):
+        """
+        :param method: entry point name
+        :param count: number of chord labels returned
+        :param na: number of them that are "NA"
+        """
+        with self.__lock:
+            stats = self.__labels.setdefault(method, [0, 0])
+            stats[0] += count
+            stats[1] += na
+
+    def snapshot(self):
+        """
+        :return: dict of calls by method (count, total, mean and percentile
+            seconds), memo by kind (hits, misses, hit rate) and labels by
+            method (count, NA count, NA rate)
+        """
+        with self.__lock:
+            calls = {m: (n, total, sorted(recent)) for m, (n, total, recent) in self.__calls.items()}
+            memo = {k: tuple(v) for k, v in self.__memo.items()}
+            labels = {m: tuple(v) for m, v in self.__labels.items()}
+
+        out = {"calls": {}, "memo": {}, "labels": {}}
+        for method, (n, total, recent) in sorted(calls.items()):
+            stats = out["calls"][method] = {"count": n, "total_seconds": total, "mean_seconds": total / n}
+            for q in self.__quantiles:
+                stats["p%g_seconds" % (100 * q)] = recent[min(len(recent) - 1, int(q * len(recent)))]
+        for kind, (hits, misses) in sorted(memo.items()):
+            out["memo"][kind] = {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses)}
+        for method, (n, na) in sorted(labels.items()):
+            out["labels"][method] = {"count": n, "na": na, "na_rate": na / n if n else 0.0}
+
+        return out
+
+    def to_json(self):
+        """
+        :return: snapshot as a JSON string
+        """
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self):
+        """
+        :return: snapshot in the Prometheus text exposition format
+        """
+        snap = self.snapshot()
+        lines = [
+            "# HELP harmony_call_seconds Latency of the Harmonizer entry points.",
+            "# TYPE harmony_call_seconds summary",
+        ]
+        for method, stats in snap["calls"].items():
+            for q in self.__quantiles:
+                lines.append('harmony_call_seconds{method="%s",quantile="%g"} %r'
+                             % (method, q, stats["p%g_seconds" % (100 * q)]))
+            lines.append('harmony_call_seconds_sum{method="%s"} %r' % (method, stats["total_seconds"]))
+            lines.append('harmony_call_seconds_count{method="%s"} %d' % (method, stats["count"]))
+
+        lines += [
+            "# HELP harmony_memo_requests_total Memo lookups by result kind and outcome.",
+            "# TYPE harmony_memo_requests_total counter",
+        ]
+        for kind, stats in snap["memo"].items():
+            lines.append('harmony_memo_requests_total{kind="%s",result="hit"} %d' % (kind, stats["hits"]))
+            lines.append('harmony_memo_requests_total{kind="%s",result="miss"} %d' % (kind, stats["misses"]))
+
+        lines += [
+            "# HELP harmony_chord_labels_total Chord labels returned, and how many were NA.",
+            "# TYPE harmony_chord_labels_total counter",
+        ]
+        for method, stats in snap["labels"].items():
+            lines.append('harmony_chord_labels_total{method="%s",result="recognized"} %d'
+                         % (method, stats["count"] - stats["na"]))
+            lines.append('harmony_chord_labels_total{method="%s",result="na"} %d' % (method, stats["na"]))
+
+        return "\n".join(lines) + "\n"
 
 
 class Harmonizer():
-    __notes = ["C", "Db", "D", "Eb", "E", "F",
-               "Gb", "G", "Ab", "A", "Bb", "B"]
+    __notes = _NOTES
 
     __major = [0, 2, 4, 5, 7, 9, 11]
     __melodic = [0, 2, 3, 5, 7, 9, 11]
@@ -60,34 +439,152 @@ class Harmonizer():
 
     }
 
+    # Seventh chord vocabulary as (quality, intervals above the chord root),
+    # in matching order. Inversions are generated by rotating the intervals.
+    __chords = [
+        ("Maj7", [0, 4, 7, 11]),
+        ("Maj7(#5)", [0, 4, 8, 11]),
+        ("7", [0, 4, 7, 10]),
+        ("7(b5)", [0, 4, 6, 10]),
+        ("sus2", [0, 2, 7, 10]),
+        ("sus2 6", [0, 2, 7, 9]),
+        ("sus2(b5)", [0, 2, 6, 10]),
+        ("sus2 6(b5)", [0, 2, 6, 9]),
+        ("sus7", [0, 5, 7, 10]),
+        ("sus7(b5)", [0, 5, 6, 10]),
+        ("sus6", [0, 5, 7, 9]),
+        ("sus6(b5)", [0, 5, 6, 9]),
+        ("6", [0, 4, 7, 9]),
+        ("min(Maj7)", [0, 3, 7, 11]),
+        ("min7", [0, 3, 7, 10]),
+        ("min6", [0, 3, 7, 9]),
+        ("min7(b5)", [0, 3, 6, 10]),
+        ("dim7", [0, 3, 6, 9]),
+        ("min7(#5)", [0, 3, 8, 10])
+    ]
+
+    __triads = [
+        ("Maj", [0, 4, 7]),
+        ("min", [0, 3, 7]),
+        ("dim", [0, 3, 6]),
+        ("aug", [0, 4, 8]),
+        ("Maj(b5)", [0, 4, 6]),
+        ("sus4", [0, 5, 7]),
+        ("sus2(no7)", [0, 2, 7]),
+        ("sus2(b5,no7)", [0, 2, 6]),
+        ("min(#5)", [0, 3, 8])
+    ]
+
+    # Tensions stacked over the seventh chords to form the 9th, 11th and
+    # 13th chords, as (name, interval) choices per extension. The b11 over
+    # minor chords and the #13 over major seventh chords come from the
+    # altered and double harmonic modes.
+    __tensions = [
+        [("b9", 1), ("9", 2), ("#9", 3)],
+        [("11", 5), ("#11", 6), ("b11", 4)],
+        [("b13", 8), ("13", 9), ("#13", 10)]
+    ]
+
+    __note_index = _SPELLINGS
+    __chord_index = _build_chord_index(__chords + __triads + _extend_chords(__chords, __tensions))
+    __suffixes = None
+
+    # Memoized results shared by all instances, keyed by (kind, root, mode).
+    __cache = {}
+    __cache_lock = threading.RLock()
+
+    # Precomputed lookup tables by name, built on first use or mapped from a
+    # file written by save_tables, and the Python objects derived from them.
+    __arrays = {}
+    __derived = {}
+
+    # Shared instances handed out by get, keyed by (root, mode).
+    __instances = {}
+
+    # Metrics being recorded, and the entry points their wrappers replaced.
+    __metrics = None
+    __unwrapped = {}
+
     def __init__(self,
                  root="C",
                  mode="major"):
 
-        assert root in self.__notes
-        assert mode in self.__modes.keys()
+        if root not in self.__note_index:
+            raise ValueError("unknown root: %r" % (root,))
+        if mode not in self.__modes:
+            raise ValueError("unknown mode: %r" % (mode,))
 
         self.root = root
         self.mode = mode
 
-    def get_scale(self):
+    @classmethod
+    def get(cls, root="C", mode="major"):
         """
-        Get the specified scale from a specified root.
+        Get the shared instance for a root and mode, created and validated
+        on first use only. Shared instances must not be modified.
 
-        :return: scale array
+        :param root: root note name
+        :param mode: mode name
+        :return: Harmonizer
+        """
+        h = cls.__instances.get((root, mode))
+        if h is None:
+            h = cls.__instances.setdefault((root, mode), cls(root=root, mode=mode))
+
+        return h
+
+    def __memo(self, kind, compute):
+        """
+        Return the memoized result of compute for this root and mode,
+        computing and storing it on first use.
+
+        :param kind: result name ("scale", "intervals" or "harmony")
+        :param compute: function producing the result as a tuple
+        :return: memoized result
+        """
+        key = (kind, self.root, self.mode)
+        value = self.__cache.get(key)
+        if value is None:
+            with self.__cache_lock:
+                value = self.__cache.get(key)
+                if value is None:
+                    value = self.__from_tables(kind)
+                    if value is None:
+                        value = compute()
+                    self.__cache[key] = value
+
+        return value
+
+    def __scale_set(self):
+        root_idx = self.__note_index[self.root]
+        mode = self.__modes[self.mode]
+
+        return Scale(root_idx + mode[0], pitch_class_set([root_idx + i for i in mode]))
+
+    def get_scale_set(self):
         """
+        Get the scale as a compact pitch-class set.
 
-        root_idx = self.__notes.index(self.root)
-        scale = [self.__notes[(root_idx + i) % 12] for i in self.__modes[self.mode]]
+        :return: Scale
+        """
+        return self.__memo("scale_set", self.__scale_set)
+
+    def __scale(self):
+        scale = _spell_scale(self.root, self.__modes[self.mode])
         scale.append(scale[0])
 
-        return scale
+        return tuple(scale)
 
-    def get_intervals(self):
+    def get_scale(self):
         """
+        Get the specified scale from a specified root, spelled with one
+        letter per degree.
 
-        :return:
+        :return: scale array
         """
+        return list(self.__memo("scale", self.__scale))
+
+    def __intervals(self):
         scale_idx = [x if x >= 0 else (12 + x) for x in
                      [(x - self.__modes[self.mode][0]) for x in self.__modes[self.mode]]]
         scale_idx.append(scale_idx[0] + 12)
@@ -98,419 +595,2267 @@ class Harmonizer():
                 2: "T",
                 3: "T1/2"
             }
-            return swt.get(x, "Invalid interval")
+            if x in swt:
+                return swt[x]
+            if 3 < x <= 12:
+                return "%dT%s" % (x // 2, "1/2" if x % 2 else "")
+            return "Invalid interval"
 
-        scale_int = [check_interval(x) for x in np.diff(scale_idx)]
+        scale_int = [check_interval(b - a) for a, b in zip(scale_idx, scale_idx[1:])]
 
-        return scale_int
+        return tuple(scale_int)
+
+    def get_intervals(self):
+        """
+        Get the steps between consecutive degrees, up to the octave: "S",
+        "T" and "T1/2", then "2T", "2T1/2" and so on for the wider steps of
+        scales with fewer than seven notes.
+
+        :return: intervals array
+        """
+        return list(self.__memo("intervals", self.__intervals))
 
     def __check_chord(self, root, x):
 
-        if len(x) == 4:
+        if len(x) == 0:
+            return "NA"
 
-            ####################### Maj7 ##############################
+        entry = self.__chord_index.get(_chord_key(x))
+        if entry is None:
+            return "NA"
 
-            if x[0] == 0 and x[1] == 4 and x[2] == 7 and x[3] == 11:
-                return root + " Maj7"
+        bass, suffix = entry
+        return _chord_label(root, bass, suffix)
 
-            if x[0] == 4 and x[1] == 7 and x[2] == 11 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 4) % 12]
-                return root + "/" + drop + " Maj7"
+    def check_chord(self, root, x):
+        """
 
-            if x[0] == 7 and x[1] == 11 and x[2] == 0 and x[3] == 4:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 7) % 12]
-                return root + "/" + drop + " Maj7"
+        :param root:
+        :param x:
+        :return:
+        """
+        return self.__check_chord(root, x)
 
-            if x[0] == 11 and x[1] == 0 and x[2] == 4 and x[3] == 7:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 11) % 12]
-                return root + "/" + drop + " Maj7"
+    @classmethod
+    def __build_chord_tables(cls):
+        """
+        Build the array form of the voicing index: a lookup table from voicing
+        key to label code, and the labels of every code for every root.
 
-            ###################### Maj7(#5) ###########################
+        :return: dict of the chord_lut and chord_labels tables
+        """
+        entries = list(cls.__chord_index.items())
 
-            if x[0] == 0 and x[1] == 4 and x[2] == 8 and x[3] == 11:
-                return root + " Maj7(#5)"
+        lut = np.zeros(12 << 12, dtype=np.int16)
+        labels = [["NA"] for _ in range(12)]
 
-            if x[0] == 4 and x[1] == 8 and x[2] == 11 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 4) % 12]
-                return root + "/" + drop + " Maj7(#5)"
+        for code, (key, (bass, suffix)) in enumerate(entries, start=1):
+            lut[key] = code
+            for r in range(12):
+                labels[r].append(_chord_label(_NOTES[r], bass, suffix))
 
-            if x[0] == 8 and x[1] == 11 and x[2] == 0 and x[3] == 4:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 8) % 12]
-                return root + "/" + drop + " Maj7(#5)"
+        return {"chord_lut": lut, "chord_labels": np.array(labels, dtype=str)}
 
-            if x[0] == 11 and x[1] == 0 and x[2] == 4 and x[3] == 8:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 11) % 12]
-                return root + "/" + drop + " Maj7(#5)"
+    @classmethod
+    def __build_set_table(cls):
+        """
+        Build the table naming every pitch-class set over every bass, as flat
+        indexes into chord_labels. Root position readings are registered
+        first so that they win over inversions.
 
-            ########################## 7 ##############################
+        :return: dict of the set_codes table
+        """
+        codes = {key: code for code, key in enumerate(cls.__chord_index, start=1)}
+        width = len(codes) + 1
 
-            if x[0] == 0 and x[1] == 4 and x[2] == 7 and x[3] == 10:
-                return root + " 7"
+        table = [0] * (12 << 12)
+        entries = sorted(cls.__chord_index.items(), key=lambda e: e[1][0] != 0)
+        for key, (interval, suffix) in entries:
+            for r in range(12):
+                k = (r + interval) % 12 << 12 | _rotate(key & 0xFFF, r)
+                if not table[k]:
+                    table[k] = r * width + codes[key]
 
-            if x[0] == 4 and x[1] == 7 and x[2] == 10 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 4) % 12]
-                return root + "/" + drop + " 7"
+        return {"set_codes": np.array(table, dtype=np.int32)}
 
-            if x[0] == 7 and x[1] == 10 and x[2] == 0 and x[3] == 4:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 7) % 12]
-                return root + "/" + drop + " 7"
+    @classmethod
+    def __table(cls, name):
+        """
+        Get a precomputed lookup table, from the mapped tables file if one was
+        loaded, else built on first use.
 
-            if x[0] == 10 and x[1] == 0 and x[2] == 4 and x[3] == 7:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 10) % 12]
-                return root + "/" + drop + " 7"
+        :param name: table name
+        :return: numpy array
+        """
+        table = cls.__arrays.get(name)
+        if table is None:
+            with cls.__cache_lock:
+                if name not in cls.__arrays:
+                    if name.startswith("chord_l"):
+                        cls.__arrays.update(cls.__build_chord_tables())
+                    elif name == "set_codes":
+                        cls.__arrays.update(cls.__build_set_table())
+                    else:
+                        cls.__arrays.update(cls.__build_reverse_index())
+                table = cls.__arrays[name]
+
+        return table
+
+    @classmethod
+    def __chord_labels(cls):
+        """
+        :return: chord labels by (root, code) as an object array
+        """
+        labels = cls.__derived.get("chord_labels")
+        if labels is None:
+            labels = cls.__derived["chord_labels"] = cls.__table("chord_labels").astype(object)
 
-            ########################## 7(b5 ##############################
+        return labels
 
-            if x[0] == 0 and x[1] == 4 and x[2] == 6 and x[3] == 10:
-                return root + " 7(b5)"
+    @classmethod
+    def __spelled_labels(cls, root):
+        """
+        :param root: chord root name
+        :return: chord labels by code with the root spelled as given, as
+            check_chord spells them, as an object array
+        """
+        spelled = cls.__derived.get("spelled_labels")
+        if spelled is None:
+            spelled = cls.__derived["spelled_labels"] = {}
+
+        labels = spelled.get(root)
+        if labels is None:
+            if root not in cls.__note_index:
+                raise ValueError("unknown note: %r" % (root,))
+            labels = np.array(["NA"] + [_chord_label(root, bass, suffix)
+                                        for bass, suffix in cls.__chord_index.values()], dtype=object)
+            spelled[root] = labels
+
+        return labels
+
+    @classmethod
+    def label_set(cls, mask, bass):
+        """
+        Name the chord formed by a pitch-class set over a given bass, guessing
+        its root. Root position readings win over inversions.
 
-            if x[0] == 4 and x[1] == 6 and x[2] == 10 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 4) % 12]
-                return root + "/" + drop + " 7(b5)"
+        :param mask: pitch-class set of the sounding notes
+        :param bass: pitch class of the lowest note
+        :return: chord label, "NA" if not recognized
+        """
+        labels = cls.__derived.get("set_labels")
+        if labels is None:
+            flat = cls.__table("chord_labels").ravel().tolist()
+            labels = cls.__derived["set_labels"] = [flat[c] for c in cls.__table("set_codes").tolist()]
 
-            if x[0] == 6 and x[1] == 10 and x[2] == 0 and x[3] == 4:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 7) % 12]
-                return root + "/" + drop + " 7(b5)"
+        return labels[(bass % 12) << 12 | (mask & 0xFFF)]
 
-            if x[0] == 10 and x[1] == 0 and x[2] == 4 and x[3] == 6:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 10) % 12]
-                return root + "/" + drop + " 7(b5)"
+    @classmethod
+    def name_chord(cls, notes):
+        """
+        Name a chord from its notes alone, guessing its root.
 
-            ########################## sus2 ###########################
+        :param notes: MIDI note numbers, the lowest being the bass, or note
+            names with the bass first
+        :return: chord label, "NA" if not recognized
+        """
+        if len(notes) == 0:
+            return "NA"
 
-            if x[0] == 0 and x[1] == 2 and x[2] == 7 and x[3] == 10:
-                return root + " sus2"
+        if isinstance(notes[0], str):
+            bass = cls.note_index(notes[0])
+        else:
+            bass = min(notes)
 
-            if x[0] == 2 and x[1] == 7 and x[2] == 10 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 2) % 12]
-                return root + "/" + drop + " sus2"
+        return cls.label_set(pitch_class_set(notes), bass)
 
-            if x[0] == 7 and x[1] == 10 and x[2] == 0 and x[3] == 2:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 7) % 12]
-                return root + "/" + drop + " sus2"
+    @classmethod
+    def parse_chord(cls, label):
+        """
+        Read back a chord label as produced by check_chord.
 
-            if x[0] == 10 and x[1] == 0 and x[2] == 2 and x[3] == 7:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 10) % 12]
-                return root + "/" + drop + " sus2"
+        :param label: chord label, e.g. "G 7" or "C/E Maj7"
+        :return: Chord
+        """
+        if cls.__suffixes is None:
+            suffixes = ({}, {})
+            for key, (bass, suffix) in cls.__chord_index.items():
+                suffixes[bass != 0].setdefault(suffix, key & 0xFFF)
+            cls.__suffixes = suffixes
+
+        def split_note(text):
+            n = 1
+            while n < 3 and text[n:n + 1] in ("b", "#"):
+                n += 1
+            return cls.note_index(text[:n]), text[n:]
+
+        try:
+            root, rest = split_note(label)
+            inversion = rest.startswith("/")
+            if inversion:
+                _, rest = split_note(rest[1:])
+            rel = cls.__suffixes[inversion][rest]
+        except (KeyError, ValueError):
+            raise ValueError("not a chord label: %r" % (label,))
+
+        return Chord(root, _rotate(rel, root))
+
+    def check_chords(self, roots, intervals):
+        """
+        Label many voicings at once, the vectorized form of check_chord.
 
-            ########################## sus2 6 ###########################
+        Each row of intervals is encoded as a 12-bit pitch-class set plus its
+        bass interval and resolved through array lookups, without a Python
+        loop over the rows.
 
-            if x[0] == 0 and x[1] == 2 and x[2] == 7 and x[3] == 9:
-                return root + " sus2 6"
+        Integer roots are spelled with flats. Roots given as note names keep
+        their spelling, as with check_chord, so "C#" gives "C# Maj7" where 1
+        gives "Db Maj7".
 
-            if x[0] == 2 and x[1] == 7 and x[2] == 9 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 2) % 12]
-                return root + "/" + drop + " sus2 6"
+        :param roots: root note index (0 for C ... 11 for B) or root note
+            name per row, or a single one
+        :param intervals: (N, k) integer array of intervals from the root, bass first
+        :return: (N,) object array of chord labels
+        """
+        lut, labels = self.__table("chord_lut"), self.__chord_labels()
 
-            if x[0] == 7 and x[1] == 9 and x[2] == 0 and x[3] == 2:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 7) % 12]
-                return root + "/" + drop + " sus2 6"
+        x = np.asarray(intervals, dtype=np.int64) % 12
+        if x.ndim != 2 or x.shape[1] == 0:
+            raise ValueError("intervals must be a non-empty (N, k) array")
 
-            if x[0] == 9 and x[1] == 0 and x[2] == 2 and x[3] == 7:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 9) % 12]
-                return root + "/" + drop + " sus2 6"
+        masks = np.bitwise_or.reduce(np.left_shift(1, x), axis=1)
+        codes = lut[(x[:, 0] << 12) | masks]
 
-            ########################## sus2(b5) ###########################
+        roots = np.asarray(roots)
+        if roots.dtype.kind in "US":
+            names, inverse = np.unique(np.broadcast_to(roots, codes.shape), return_inverse=True)
+            spelled = np.stack([self.__spelled_labels(str(n)) for n in names.tolist()])
+            return spelled[inverse.reshape(codes.shape), codes]
 
-            if x[0] == 0 and x[1] == 2 and x[2] == 6 and x[3] == 10:
-                return root + " sus2(b5)"
+        roots = np.broadcast_to(roots.astype(np.int64) % 12, codes.shape)
+        return labels[roots, codes]
 
-            if x[0] == 2 and x[1] == 6 and x[2] == 10 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 2) % 12]
-                return root + "/" + drop + " sus2(b5)"
+    def __depth(self, depth):
+        """
+        :param depth: requested number of notes per chord
+        :return: depth capped at the number of notes of the scale
+        """
+        if not 3 <= depth <= 7:
+            raise ValueError("depth must be between 3 and 7, got %r" % (depth,))
+
+        return min(depth, len(self.__modes[self.mode]))
+
+    # ideal distance of each chord tone from the chord root when stacking
+    # thirds: root, third, fifth, seventh, ninth, eleventh, thirteenth
+    __TERTIAN = [0, 3.5, 7, 10, 14, 17, 21]
+
+    def __degrees(self, depth):
+        """
+        Pick the scale positions of the chord built on each degree.
+
+        Seven-note scales stack every other degree. Other scales have no
+        such regular third, so each chord tone is the unused scale note
+        nearest in pitch to the ideal tertian distance above the root,
+        the lower one on ties.
 
-            if x[0] == 6 and x[1] == 10 and x[2] == 0 and x[3] == 2:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 6) % 12]
-                return root + "/" + drop + " sus2(b5)"
+        :param depth: number of notes per chord
+        :return: for each degree, the positions of its notes in the scale
+        """
+        depth = self.__depth(depth)
+        idx = self.get_scale_set().intervals()
+        n = len(idx)
+
+        if n == 7:
+            return [[(i + 2 * k) % n for k in range(depth)] for i in range(n)]
+
+        degrees = []
+        for i in range(n):
+            rel = [(idx[j] - idx[i]) % 12 for j in range(n)]
+            chord = [i]
+            for target in self.__TERTIAN[1:depth]:
+                target %= 12
+                chord.append(min((j for j in range(n) if j not in chord),
+                                 key=lambda j: (min(abs(rel[j] - target), 12 - abs(rel[j] - target)), rel[j])))
+            degrees.append(chord)
+
+        return degrees
+
+    def __stacks(self, depth):
+        """
+        :param depth: number of notes per chord
+        :return: for each degree, the scale notes stacked in thirds over it
+        """
+        sc = self.get_scale_set()
+        idx = sc.intervals()
 
-            if x[0] == 10 and x[1] == 0 and x[2] == 2 and x[3] == 6:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 10) % 12]
-                return root + "/" + drop + " sus2(b5)"
+        return [[sc.root + idx[j] for j in chord] for chord in self.__degrees(depth)]
 
-            ########################## sus2 6(b5) ###########################
+    def harmonize_sets(self, depth=4):
+        """
+        Get the chords built on each degree of the scale as compact
+        pitch-class sets.
 
-            if x[0] == 0 and x[1] == 2 and x[2] == 6 and x[3] == 9:
-                return root + " sus2 6(b5)"
+        :param depth: number of stacked notes, 3 for triads up to 7 for 13th
+            chords, capped for scales with fewer notes
+        :return: list of Chord
+        """
+        return list(self.__memo("chord_sets%d" % depth,
+                                lambda: tuple(Chord(c[0], pitch_class_set(c)) for c in self.__stacks(depth))))
 
-            if x[0] == 2 and x[1] == 6 and x[2] == 9 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 2) % 12]
-                return root + "/" + drop + " sus2 6(b5)"
+    def __harmonize(self, depth):
+        sc = self.__memo("scale", self.__scale)[:-1]
 
-            if x[0] == 6 and x[1] == 9 and x[2] == 0 and x[3] == 2:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 6) % 12]
-                return root + "/" + drop + " sus2 6(b5)"
+        h = []
+        for c, chord in zip(self.harmonize_sets(depth), self.__degrees(depth)):
+            chrd = tuple(sc[j] for j in chord)
+            h.append((self.__check_chord(chrd[0], c.intervals()), chrd))
+
+        return tuple(h)
+
+    def harmonize(self, depth=4):
+        """
+        Build a chord on each degree of the scale by stacking thirds.
+
+        :param depth: number of stacked notes, 3 for triads, 4 for seventh
+            chords (the default) up to 7 for 13th chords, capped so that
+            no note repeats on scales with fewer notes
+        :return: list of {label: notes} dicts, one per degree
+        """
+        kind = "harmony" if depth == 4 else "harmony%d" % depth
+        return [{label: list(chrd)} for label, chrd in self.__memo(kind, lambda: self.__harmonize(depth))]
+
+    def voice_lead(self, degrees, depth=4, low=48, high=84):
+        """
+        Voice a progression of scale degrees with minimal voice movement.
+
+        :param degrees: sequence of degrees, counted from 1
+        :param depth: number of stacked notes per chord
+        :param low: lowest allowed MIDI note
+        :param high: highest allowed MIDI note
+        :return: (list of voicings as lists of MIDI notes, total movement in semitones)
+        """
+        chords = self.harmonize_sets(depth)
+        degrees = list(degrees)
+        for d in degrees:
+            if not isinstance(d, int) or not 1 <= d <= len(chords):
+                raise ValueError("degree must be between 1 and %d, got %r" % (len(chords), d))
+
+        return voice_lead([chords[d - 1] for d in degrees], low=low, high=high)
+
+    @classmethod
+    def __label_qualities(cls):
+        """
+        Build, once, the chord root and quality of every label of the chord
+        tables. Qualities are the distinct pitch-class sets of the vocabulary
+        relative to the chord root, numbered from 1.
+
+        :return: ((chord root, quality) by label, quality sets, quality by set)
+        """
+        info = cls.__derived.get("label_qualities")
+        if info is None:
+            sets = [0]
+            index = {}
+            qualities = []
+            for key in cls.__chord_index:
+                rel = key & 0xFFF
+                if rel not in index:
+                    index[rel] = len(sets)
+                    sets.append(rel)
+                qualities.append(index[rel])
+
+            by_label = {}
+            for r, row in enumerate(cls.__table("chord_labels").tolist()):
+                for label, q in zip(row[1:], qualities):
+                    by_label.setdefault(label, (r, q))
+
+            info = cls.__derived["label_qualities"] = (by_label, sets, index)
+
+        return info
+
+    @classmethod
+    def __analysis_table(cls, mode):
+        """
+        Build, once per mode, the analysis of every chord quality on every
+        root, as ids into the shared list of (numeral, function, source)
+        results.
+
+        :param mode: mode name
+        :return: (12, qualities) array of result ids indexed by the chord
+            root above the tonic and the quality
+        """
+        tables = cls.__derived.setdefault("analysis", {})
+        table = tables.get(mode)
+        if table is not None:
+            return table
+
+        _, sets, _ = cls.__label_qualities()
+        results = cls.__derived.setdefault("analysis_results", {("NA", "NA", ""): 0})
+
+        def degrees(m):
+            return [(i - cls.__modes[m][0]) % 12 for i in cls.__modes[m]]
+
+        degs = degrees(mode)
+        n = len(degs)
+        home = sum(1 << i for i in degs)
+
+        # Parallel modes over the same tonic, those of the earliest parent
+        # scale first, then the closest to this one.
+        families = {}
+        ranked = []
+        for i, m in enumerate(cls.__modes):
+            mask = sum(1 << d for d in degrees(m))
+            family = families.setdefault(min(_rotate(mask, -d) for d in degrees(m)), len(families))
+            if mask != home:
+                ranked.append((family, (mask ^ home).bit_count(), i, m, mask))
+        others = [(m, mask, degrees(m)) for _, _, _, m, mask in sorted(ranked)]
+        masks = np.array([mask for _, mask, _ in others], dtype=np.int64)
+
+        def numeral_on(rr):
+            if rr in degs:
+                return "", degs.index(rr)
+            if (rr + 1) % 12 in degs:
+                return "b", degs.index((rr + 1) % 12)
+            if (rr - 1) % 12 in degs:
+                return "#", degs.index((rr - 1) % 12)
+            major = [0, 2, 4, 5, 7, 9, 11]
+            return ("", major.index(rr)) if rr in major else ("b", major.index(rr + 1))
+
+        rels = np.array(sets, dtype=np.int64)
+        table = np.zeros((12, len(sets)), dtype=np.int32)
+        with cls.__cache_lock:
+            for rr in range(12):
+                chords = ((rels << rr) | (rels >> (12 - rr))) & 0xFFF
+                fits = (chords[:, None] & masks[None, :]) == chords[:, None]
+                borrowed = np.where(fits.any(axis=1), fits.argmax(axis=1), -1).tolist()
+                accidental, degree = numeral_on(rr)
+                target = (rr - 7) % 12
+
+                for q in range(1, len(sets)):
+                    rel = sets[q]
+                    if not accidental and chords[q] & home == chords[q]:
+                        function = _HEPTATONIC_FUNCTIONS[degree] if n == 7 else _FUNCTIONS[rr]
+                        result = (_roman_numeral("", degree, rel), function, "")
+                    elif rel >> 4 & 1 and rel >> 7 & 1 and not rel >> 11 & 1 and target and target in degs:
+                        t = degs.index(target)
+                        third = (degs[(t + 2) % n] - target) % 12
+                        if third in (3, 4) and (degs[(t + 4) % n] - target) % 12 == 7:
+                            tonicized = _roman_numeral("", t, 1 | 1 << third | 1 << 7)
+                            result = (_roman_numeral("", 4, rel) + "/" + tonicized, "secondary dominant", tonicized)
+                        else:
+                            result = None
+                    else:
+                        result = None
+
+                    if result is None:
+                        numeral = _roman_numeral(accidental, degree, rel)
+                        if borrowed[q] >= 0:
+                            # Number the root by its degree in the mode the
+                            # chord comes from, altered from the same degree
+                            # of this mode: #iv from lydian, bVI from aeolian.
+                            source, _, source_degs = others[borrowed[q]]
+                            if accidental and len(source_degs) == n:
+                                d = source_degs.index(rr)
+                                shift = rr - degs[d]
+                                numeral = _roman_numeral("#" * shift if shift > 0 else "b" * -shift, d, rel)
+                            result = (numeral, "borrowed", source)
+                        else:
+                            result = (numeral, "chromatic", "")
+
+                    table[rr, q] = results.setdefault(result, len(results))
+
+            tables[mode] = table
+
+        return table
+
+    @classmethod
+    def analyze_batch(cls, labels, roots, modes):
+        """
+        Analyze chord labels against keys, column-wise: Roman numeral,
+        harmonic function, and the tonicized degree of secondary dominants
+        or the parallel mode that borrowed chords come from.
+
+        Functions are "tonic", "subdominant" and "dominant" for chords of
+        the scale, then "secondary dominant", "borrowed" (from the parallel
+        mode closest to the key's), "chromatic" and "NA". Each distinct
+        label and key is resolved once, and each row is then a lookup in
+        precomputed tables by mode, chord root above the tonic and quality.
+
+        :param labels: chord labels as produced by check_chord, e.g. a
+            whole collection of progressions flattened into one sequence
+        :param roots: key root per label, or one root for all
+        :param modes: key mode per label, or one mode for all
+        :return: (numerals, functions, sources) object arrays
+        """
+        by_label, _, quality_of = cls.__label_qualities()
+
+        ids = {}
+        rows = np.array([ids.setdefault(label, len(ids)) for label in labels], dtype=np.intp)
+        if not len(rows):
+            return tuple(np.array([], dtype=object) for _ in range(3))
+
+        chord_roots = np.zeros(len(ids), dtype=np.intp)
+        qualities = np.zeros(len(ids), dtype=np.intp)
+        for label, i in ids.items():
+            entry = by_label.get(label)
+            if entry is None and label != "NA":
+                try:
+                    chord = cls.parse_chord(str(label))
+                except ValueError:
+                    pass
+                else:
+                    entry = (chord.root, quality_of.get(_rotate(chord.mask, -chord.root), 0))
+            if entry is not None:
+                chord_roots[i], qualities[i] = entry
+
+        for column in (roots, modes):
+            if not isinstance(column, str) and len(column) != len(rows):
+                raise ValueError("expected %d keys, got %d" % (len(rows), len(column)))
+        roots = itertools.repeat(roots, len(rows)) if isinstance(roots, str) else roots
+        modes = itertools.repeat(modes, len(rows)) if isinstance(modes, str) else modes
+        keys = {}
+        key_rows = np.array([keys.setdefault(key, len(keys)) for key in zip(roots, modes)], dtype=np.intp)
+
+        mode_names = list(dict.fromkeys(mode for _, mode in keys))
+        tonics = np.array([cls.get(root=root, mode=mode).get_scale_set().root for root, mode in keys])
+        key_modes = np.array([mode_names.index(mode) for _, mode in keys])
+        tables = np.stack([cls.__analysis_table(mode) for mode in mode_names])
+
+        result = tables[key_modes[key_rows], (chord_roots[rows] - tonics[key_rows]) % 12, qualities[rows]]
+
+        results = list(cls.__derived["analysis_results"])
+        return tuple(np.array([r[i] for r in results], dtype=object)[result] for i in range(3))
+
+    def analyze(self, labels):
+        """
+        Analyze a progression in this key, see analyze_batch.
+
+        :param labels: chord labels as produced by check_chord
+        :return: list of (numeral, function, source) per chord
+        """
+        return list(zip(*(column.tolist() for column in self.analyze_batch(labels, self.root, self.mode))))
+
+    @classmethod
+    def warm_cache(cls):
+        """
+        Populate the memo for every root and mode.
+        """
+        for root in cls.__notes:
+            for mode in cls.__modes:
+                h = cls.get(root=root, mode=mode)
+                h.get_scale()
+                h.get_intervals()
+                h.harmonize()
+
+    @classmethod
+    def clear_cache(cls):
+        """
+        Drop every memoized result.
+        """
+        with cls.__cache_lock:
+            cls.__cache.clear()
 
-            if x[0] == 9 and x[1] == 0 and x[2] == 2 and x[3] == 6:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 9) % 12]
-                return root + "/" + drop + " sus2 6(b5)"
+    @classmethod
+    def __instrumented(cls, metrics):
+        """
+        :param metrics: Metrics to record into
+        :return: instrumented replacements of the entry points and of the
+            memo, by class attribute name
+        """
+        clock = time.perf_counter
+        cache = cls.__cache
+
+        def timed(name, fn, labels=None):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                t = clock()
+                result = fn(*args, **kwargs)
+                metrics.record_call(name, clock() - t)
+                if labels is not None:
+                    metrics.record_labels(name, *labels(result))
+                return result
+
+            return wrapper
+
+        memo = cls.__dict__["_Harmonizer__memo"]
+
+        @functools.wraps(memo)
+        def counted_memo(self, kind, compute):
+            metrics.record_memo(kind, (kind, self.root, self.mode) in cache)
+            return memo(self, kind, compute)
+
+        return {
+            "get_scale": timed("get_scale", cls.__dict__["get_scale"]),
+            "get_intervals": timed("get_intervals", cls.__dict__["get_intervals"]),
+            "check_chord": timed("check_chord", cls.__dict__["check_chord"],
+                                 lambda label: (1, label == "NA")),
+            "harmonize": timed("harmonize", cls.__dict__["harmonize"],
+                               lambda chords: (len(chords), sum("NA" in c for c in chords))),
+            "_Harmonizer__memo": counted_memo,
+        }
+
+    @classmethod
+    def enable_metrics(cls, samples=10000):
+        """
+        Start recording metrics on get_scale, get_intervals, check_chord and
+        harmonize by swapping in instrumented versions of them. While
+        disabled, the plain methods run and nothing is recorded.
 
-            ########################## sus7 ###########################
+        :param samples: number of recent calls kept per method for the
+            latency percentiles
+        :return: Metrics being recorded, the existing one if already enabled
+        """
+        with cls.__cache_lock:
+            if cls.__metrics is None:
+                metrics = Metrics(samples=samples)
+                wrappers = cls.__instrumented(metrics)
+                cls.__unwrapped = {name: cls.__dict__[name] for name in wrappers}
+                for name, fn in wrappers.items():
+                    setattr(cls, name, fn)
+                cls.__metrics = metrics
+
+            return cls.__metrics
+
+    @classmethod
+    def disable_metrics(cls):
+        """
+        Stop recording metrics and restore the plain methods.
 
-            if x[0] == 0 and x[1] == 5 and x[2] == 7 and x[3] == 10:
-                return root + " sus7"
+        :return: Metrics recorded so far, None if they were not enabled
+        """
+        with cls.__cache_lock:
+            metrics = cls.__metrics
+            for name, fn in cls.__unwrapped.items():
+                setattr(cls, name, fn)
+            cls.__unwrapped = {}
+            cls.__metrics = None
 
-            if x[0] == 5 and x[1] == 7 and x[2] == 10 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 5) % 12]
-                return root + "/" + drop + " sus7"
+        return metrics
 
-            if x[0] == 7 and x[1] == 10 and x[2] == 0 and x[3] == 5:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 7) % 12]
-                return root + "/" + drop + " sus7"
+    @classmethod
+    def metrics(cls):
+        """
+        :return: Metrics being recorded, None if disabled
+        """
+        return cls.__metrics
 
-            if x[0] == 10 and x[1] == 0 and x[2] == 5 and x[3] == 7:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 10) % 12]
-                return root + "/" + drop + " sus7"
+    @classmethod
+    def save_cache(cls, path):
+        """
+        Write the full memo table to a JSON file, for load_cache.
 
-            ########################## sus7(b5) ###########################
+        :param path: output file path
+        """
+        cls.warm_cache()
 
-            if x[0] == 0 and x[1] == 5 and x[2] == 6 and x[3] == 10:
-                return root + " sus7(b5)"
+        entries = [{"kind": kind, "root": root, "mode": mode, "value": value}
+                   for (kind, root, mode), value in list(cls.__cache.items())
+                   if kind in ("scale", "intervals") or kind.startswith("harmony")]
+        with open(path, "w") as f:
+            json.dump({"version": 4, "entries": entries}, f)
 
-            if x[0] == 5 and x[1] == 6 and x[2] == 10 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 5) % 12]
-                return root + "/" + drop + " sus7(b5)"
+    @classmethod
+    def load_cache(cls, path):
+        """
+        Populate the memo from a file written by save_cache.
 
-            if x[0] == 6 and x[1] == 10 and x[2] == 0 and x[3] == 5:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 6) % 12]
-                return root + "/" + drop + " sus7(b5)"
+        :param path: input file path
+        """
+        with open(path) as f:
+            data = json.load(f)
 
-            if x[0] == 10 and x[1] == 0 and x[2] == 5 and x[3] == 6:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 10) % 12]
-                return root + "/" + drop + " sus7(b5)"
+        if data.get("version") != 4:
+            raise ValueError("unsupported cache file version: %r" % data.get("version"))
 
-            ########################## sus6 ###########################
+        loaded = {}
+        for e in data["entries"]:
+            if e["kind"].startswith("harmony"):
+                value = tuple((label, tuple(chrd)) for label, chrd in e["value"])
+            else:
+                value = tuple(e["value"])
+            loaded[(e["kind"], e["root"], e["mode"])] = value
 
-            if x[0] == 0 and x[1] == 5 and x[2] == 7 and x[3] == 9:
-                return root + " sus6"
+        with cls.__cache_lock:
+            cls.__cache.update(loaded)
 
-            if x[0] == 5 and x[1] == 7 and x[2] == 9 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 5) % 12]
-                return root + "/" + drop + " sus6"
+    @classmethod
+    def __tables_digest(cls):
+        """
+        :return: digest of the chord vocabulary the tables derive from
+        """
+        source = [cls.__notes, sorted(cls.__chord_index.items())]
+        return hashlib.sha1(json.dumps(source).encode()).hexdigest()
 
-            if x[0] == 7 and x[1] == 9 and x[2] == 0 and x[3] == 5:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 7) % 12]
-                return root + "/" + drop + " sus6"
+    @classmethod
+    def save_tables(cls, path):
+        """
+        Write every precomputed lookup table, and the scale, intervals and
+        harmonization of every root and mode, to a binary file for
+        load_tables. Arrays are stored raw and 64-byte aligned after a JSON
+        header, so that they can be mapped in place.
 
-            if x[0] == 9 and x[1] == 0 and x[2] == 5 and x[3] == 7:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 9) % 12]
-                return root + "/" + drop + " sus6"
+        :param path: output file path
+        """
+        modes = list(cls.__modes)
+        width = max(len(v) for v in cls.__modes.values())
+        shape = (len(cls.__notes), len(modes))
+
+        scale_names = np.full(shape + (width + 1,), "", dtype="U3")
+        intervals = np.full(shape + (width,), "", dtype="U16")
+        harmony_labels = np.full(shape + (width,), "", dtype="U32")
+        harmony_notes = np.full(shape + (width, 4), "", dtype="U3")
+        for r, root in enumerate(cls.__notes):
+            for m, mode in enumerate(modes):
+                h = cls.get(root=root, mode=mode)
+                scale = h.get_scale()
+                scale_names[r, m, :len(scale)] = scale
+                intervals[r, m, :len(scale) - 1] = h.get_intervals()
+                for i, chord in enumerate(h.harmonize()):
+                    (label, notes), = chord.items()
+                    harmony_labels[r, m, i] = label
+                    harmony_notes[r, m, i, :len(notes)] = notes
+
+        arrays = {name: cls.__table(name) for name in
+                  ("chord_lut", "chord_labels", "set_codes",
+                   "chord_offsets", "chord_entries", "scale_offsets", "scale_pairs")}
+        arrays.update(scale_names=scale_names, intervals=intervals,
+                      harmony_labels=harmony_labels, harmony_notes=harmony_notes)
+
+        layout = {}
+        offset = 0
+        for name, a in arrays.items():
+            layout[name] = [a.dtype.str, list(a.shape), offset]
+            offset += -(-a.nbytes // 64) * 64
+
+        header = json.dumps({"version": _TABLES_VERSION, "digest": cls.__tables_digest(),
+                             "roots": cls.__notes, "modes": [[m, cls.__modes[m]] for m in modes],
+                             "pairs": cls.__table("pairs"), "arrays": layout}).encode()
+        start = -(-(len(_TABLES_MAGIC) + 4 + len(header)) // 64) * 64
+
+        with open(path, "wb") as f:
+            f.write(_TABLES_MAGIC + struct.pack("<I", len(header)) + header)
+            for name, a in arrays.items():
+                f.seek(start + layout[name][2])
+                f.write(np.ascontiguousarray(a).tobytes())
+            f.truncate(start + offset)
+
+    @classmethod
+    def load_tables(cls, path):
+        """
+        Map a file written by save_tables read-only and use its tables from
+        now on. The pages are shared by every process mapping the same file.
+        Modes of the file missing from this process, such as registered
+        scales, are registered, and a mode whose intervals differ is an
+        error.
 
-            ########################## sus6(b5) ###########################
+        :param path: input file path
+        """
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mm[:len(_TABLES_MAGIC)] != _TABLES_MAGIC:
+            raise ValueError("not a harmony tables file: %r" % (path,))
+
+        size, = struct.unpack_from("<I", mm, len(_TABLES_MAGIC))
+        header = json.loads(mm[len(_TABLES_MAGIC) + 4:len(_TABLES_MAGIC) + 4 + size])
+        if header["version"] != _TABLES_VERSION:
+            raise ValueError("unsupported tables file version: %r" % header["version"])
+        if header["digest"] != cls.__tables_digest():
+            raise ValueError("tables file %r was built for other chords" % (path,))
+        for mode, intervals in header["modes"]:
+            if mode in cls.__modes and cls.__modes[mode] != intervals:
+                raise ValueError("tables file %r has a different mode %r" % (path, mode))
+
+        start = -(-(len(_TABLES_MAGIC) + 4 + size) // 64) * 64
+        arrays = {}
+        for name, (dtype, shape, offset) in header["arrays"].items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            arrays[name] = np.frombuffer(mm, dtype=dtype, count=count, offset=start + offset).reshape(shape)
+
+        arrays["pairs"] = [tuple(p) for p in header["pairs"]]
+        modes = [mode for mode, _ in header["modes"]]
+
+        with cls.__cache_lock:
+            for mode, intervals in header["modes"]:
+                cls.__modes.setdefault(mode, intervals)
+            cls.__arrays = arrays
+            cls.__derived = {"table_index": {(root, mode): (r, m)
+                                             for r, root in enumerate(header["roots"])
+                                             for m, mode in enumerate(modes)}}
+            cls.__extend_reverse_index([mode for mode in cls.__modes if mode not in modes])
+
+    def __from_tables(self, kind):
+        """
+        :param kind: memo entry name
+        :return: memo entry for this root and mode read from the mapped
+            tables, None if not available there
+        """
+        index = self.__derived.get("table_index")
+        rm = index and index.get((self.root, self.mode))
+        if not rm:
+            return None
+
+        if kind == "scale":
+            return tuple(n for n in self.__arrays["scale_names"][rm].tolist() if n)
+        if kind == "intervals":
+            return tuple(i for i in self.__arrays["intervals"][rm].tolist() if i)
+        if kind == "harmony":
+            labels = self.__arrays["harmony_labels"][rm].tolist()
+            notes = self.__arrays["harmony_notes"][rm].tolist()
+            return tuple((label, tuple(x for x in n if x)) for label, n in zip(labels, notes) if label)
+
+        return None
+
+    @classmethod
+    def __index_pairs(cls, pairs):
+        """
+        Collect the reverse index rows of some (root, mode) pairs.
 
-            if x[0] == 0 and x[1] == 5 and x[2] == 6 and x[3] == 9:
-                return root + " sus6(b5)"
+        :param pairs: (pair id, root, mode) triples
+        :return: (scale keys, scale rows, chord keys, chord rows), where
+            every pitch-class set contained in a scale is a scale key and
+            every chord of its harmonizations, triads to 13th chords, is a
+            chord key
+        """
+        scale_keys, scale_rows, chord_keys, chord_rows = [], [], [], []
+        for p, root, mode in pairs:
+            h = cls.get(root=root, mode=mode)
+            mask = sub = h.get_scale_set().mask
+            while True:
+                scale_keys.append(sub)
+                scale_rows.append(p)
+                if sub == 0:
+                    break
+                sub = (sub - 1) & mask
+            seen = set()
+            for depth in range(3, 8):
+                for degree, c in enumerate(h.harmonize_sets(depth), start=1):
+                    if (c.mask, degree) not in seen:
+                        seen.add((c.mask, degree))
+                        chord_keys.append(c.mask)
+                        chord_rows.append((c.root, p, degree))
+
+        return scale_keys, scale_rows, chord_keys, chord_rows
+
+    @classmethod
+    def __build_reverse_index(cls):
+        """
+        Build the inverted indexes over every root and mode, in compressed
+        sparse row form: for each chord pitch-class set the (chord root, pair
+        id, degree) rows holding it, and for each pitch-class set the pair ids
+        whose scale contains it. Pair ids index the (root, mode) pairs list.
 
-            if x[0] == 5 and x[1] == 6 and x[2] == 9 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 5) % 12]
-                return root + "/" + drop + " sus6(b5)"
+        :return: dict of the pairs, chord_offsets, chord_entries,
+            scale_offsets and scale_pairs tables
+        """
+        pairs = [(root, mode) for root in cls.__notes for mode in cls.__modes]
+        scale_keys, scale_rows, chord_keys, chord_rows = cls.__index_pairs(
+            (p, root, mode) for p, (root, mode) in enumerate(pairs))
+
+        empty = np.zeros(4097, dtype=np.int32)
+        chord_offsets, chord_entries = _csr_append(empty, np.zeros((0, 3), dtype=np.int32),
+                                                   chord_keys, chord_rows)
+        scale_offsets, scale_pairs = _csr_append(empty, np.zeros(0, dtype=np.int32),
+                                                 scale_keys, scale_rows)
+
+        return {
+            "pairs": pairs,
+            "chord_offsets": chord_offsets,
+            "chord_entries": chord_entries,
+            "scale_offsets": scale_offsets,
+            "scale_pairs": scale_pairs,
+        }
+
+    @classmethod
+    def __extend_reverse_index(cls, modes):
+        """
+        Add the pairs of every root with some new modes to the reverse index,
+        if it is already built or mapped, without rebuilding the rest.
 
-            if x[0] == 6 and x[1] == 9 and x[2] == 0 and x[3] == 5:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 6) % 12]
-                return root + "/" + drop + " sus6(b5)"
+        :param modes: mode names
+        """
+        with cls.__cache_lock:
+            arrays = dict(cls.__arrays)
+            if not modes or "pairs" not in arrays:
+                return
+
+            start = len(arrays["pairs"])
+            pairs = [(root, mode) for root in cls.__notes for mode in modes]
+            scale_keys, scale_rows, chord_keys, chord_rows = cls.__index_pairs(
+                (p, root, mode) for p, (root, mode) in enumerate(pairs, start=start))
+
+            arrays["pairs"] = arrays["pairs"] + pairs
+            arrays["chord_offsets"], arrays["chord_entries"] = _csr_append(
+                arrays["chord_offsets"], arrays["chord_entries"], chord_keys, chord_rows)
+            arrays["scale_offsets"], arrays["scale_pairs"] = _csr_append(
+                arrays["scale_offsets"], arrays["scale_pairs"], scale_keys, scale_rows)
+            cls.__arrays = arrays
+            cls.__derived.pop("similarity", None)
+
+    @classmethod
+    def __forget_modes(cls, modes):
+        """
+        Drop some modes along with their shared instances and memoized
+        results, undoing a registration that could not be indexed.
 
-            if x[0] == 9 and x[1] == 0 and x[2] == 5 and x[3] == 6:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 9) % 12]
-                return root + "/" + drop + " sus6(b5)"
+        :param modes: mode names
+        """
+        modes = set(modes)
+        with cls.__cache_lock:
+            for mode in modes:
+                cls.__modes.pop(mode, None)
+            for key in [k for k in cls.__instances if k[1] in modes]:
+                del cls.__instances[key]
+            for key in [k for k in cls.__cache if k[2] in modes]:
+                del cls.__cache[key]
+
+    @classmethod
+    def register_scale(cls, name, intervals, modes=None):
+        """
+        Register a parent scale of any size along with all its rotations as
+        new modes. The reverse indexes are extended in place, and key
+        detectors created afterwards consider the new modes.
+
+        :param name: scale name, also the name of its first mode
+        :param intervals: semitones above the root in ascending order,
+            starting at 0, e.g. [0, 2, 4, 7, 9]
+        :param modes: names of the rotations in order, by default the scale
+            name then "<name> 2", "<name> 3" and so on
+        :return: list of the new mode names
+        """
+        intervals = list(intervals)
+        if (not intervals or intervals[0] != 0 or intervals[-1] > 11
+                or any(not isinstance(i, int) for i in intervals)
+                or any(b <= a for a, b in zip(intervals, intervals[1:]))):
+            raise ValueError("intervals must rise from 0 within one octave, got %r" % (intervals,))
+
+        if modes is None:
+            modes = [name] + ["%s %d" % (name, i) for i in range(2, len(intervals) + 1)]
+        modes = list(modes)
+        if len(modes) != len(intervals):
+            raise ValueError("expected %d mode names, got %d" % (len(intervals), len(modes)))
+
+        with cls.__cache_lock:
+            taken = [m for m in modes if m in cls.__modes]
+            if taken or len(set(modes)) != len(modes):
+                raise ValueError("mode names already in use: %r" % (taken or modes,))
+
+            for i, mode in enumerate(modes):
+                cls.__modes[mode] = intervals[i:] + intervals[:i]
+            try:
+                cls.__extend_reverse_index(modes)
+            except BaseException:
+                cls.__forget_modes(modes)
+                raise
+            cls.__derived.pop("analysis", None)
+
+        return modes
+
+    @classmethod
+    def find_chord(cls, chord):
+        """
+        Find every root and mode whose harmonization, at any depth,
+        contains a chord.
 
-            ########################## 6 ##############################
+        :param chord: Chord, chord notes root first (names, pitch classes or
+            MIDI numbers), or a bare pitch-class set to match any chord root
+        :return: list of (root, mode, degree) with degree counted from 1
+        """
+        if isinstance(chord, int):
+            root = None
+        else:
+            if not isinstance(chord, Chord):
+                chord = Chord.from_notes(chord)
+            root, chord = chord.root, chord.mask
+        chord &= 0xFFF
+
+        cls.__table("pairs")
+        arrays = cls.__arrays
+        offsets, pairs = arrays["chord_offsets"], arrays["pairs"]
+        rows = arrays["chord_entries"][offsets[chord]:offsets[chord + 1]].tolist()
+
+        return [pairs[p] + (d,) for c, p, d in rows if root is None or c == root]
+
+    @classmethod
+    def find_modes(cls, notes):
+        """
+        Find every root and mode whose scale contains all the given notes.
 
-            if x[0] == 0 and x[1] == 4 and x[2] == 7 and x[3] == 9:
-                return root + "6"
+        :param notes: note names, pitch classes, MIDI numbers, or a pitch-class set
+        :return: list of (root, mode)
+        """
+        mask = notes if isinstance(notes, int) else getattr(notes, "mask", None)
+        if mask is None:
+            mask = pitch_class_set(notes)
+        mask &= 0xFFF
 
-            if x[0] == 4 and x[1] == 7 and x[2] == 9 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 4) % 12]
-                return root + "/" + drop + "6"
+        cls.__table("pairs")
+        arrays = cls.__arrays
+        offsets, pairs = arrays["scale_offsets"], arrays["pairs"]
 
-            if x[0] == 7 and x[1] == 9 and x[2] == 0 and x[3] == 4:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 7) % 12]
-                return root + "/" + drop + "6"
+        return [pairs[p] for p in arrays["scale_pairs"][offsets[mask]:offsets[mask + 1]].tolist()]
 
-            if x[0] == 9 and x[1] == 0 and x[2] == 4 and x[3] == 7:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 9) % 12]
-                return root + "/" + drop + "6"
+    @classmethod
+    def __similarity_index(cls):
+        """
+        Build, once, the candidates of similar_scales and similar_chords:
+        every distinct scale and chord pitch-class set with its size, its
+        interval vector and its readings over every root and mode.
 
-            ########################## min(Maj7) ######################
+        :return: dict of (masks, sizes, vectors, items) by "scales" and
+            "chords"
+        """
+        index = cls.__derived.get("similarity")
+        if index is not None:
+            return index
+
+        cls.__table("pairs")
+        arrays = cls.__arrays
+        pairs = arrays["pairs"]
+        popcount, vectors = _set_tables()
+
+        scales = {}
+        for root, mode in pairs:
+            s = cls.get(root=root, mode=mode).get_scale_set()
+            scales.setdefault(s.mask, (s, []))[1].append((root, mode))
+
+        offsets = arrays["chord_offsets"]
+        entries = arrays["chord_entries"].tolist()
+        chords = {}
+        for mask in np.flatnonzero(np.diff(offsets)).tolist():
+            for c, p, d in entries[offsets[mask]:offsets[mask + 1]]:
+                chords.setdefault((c, mask), (Chord(c, mask), []))[1].append(pairs[p] + (d,))
+
+        index = {}
+        for kind, groups in (("scales", scales), ("chords", chords)):
+            items = list(groups.values())
+            masks = np.array([x.mask for x, _ in items], dtype=np.int64)
+            index[kind] = (masks, popcount[masks], vectors[masks], items)
+
+        cls.__derived["similarity"] = index
+        return index
+
+    @classmethod
+    def __nearest(cls, kind, notes, k, metric):
+        """
+        :param kind: "scales" or "chords"
+        :param notes: note names, pitch classes, MIDI numbers, or a pitch-class set
+        :param k: number of results
+        :param metric: "common" or "interval"
+        :return: list of (score, pitch-class set, readings)
+        """
+        mask = notes if isinstance(notes, int) else getattr(notes, "mask", None)
+        if mask is None:
+            mask = pitch_class_set(notes)
+        mask &= 0xFFF
+
+        masks, sizes, vectors, items = cls.__similarity_index()[kind]
+        popcount, all_vectors = _set_tables()
+
+        common = popcount[masks & mask]
+        differ = sizes + popcount[mask] - 2 * common
+        if metric == "common":
+            score = common
+            order = np.lexsort((differ, -common))
+        elif metric == "interval":
+            score = np.abs(vectors - all_vectors[mask]).sum(axis=1)
+            order = np.lexsort((differ, -common, score))
+        else:
+            raise ValueError("metric must be 'common' or 'interval', got %r" % (metric,))
+
+        return [(int(score[i]), items[i][0], list(items[i][1])) for i in order[:k].tolist()]
+
+    @classmethod
+    def similar_scales(cls, notes, k=10, metric="common"):
+        """
+        Find the scales of every root and mode closest to a pitch-class set.
+
+        With the "common" metric the scales sharing the most notes with it
+        come first. With the "interval" metric the scales whose interval
+        vector is nearest come first, whatever their transposition. Ties are
+        broken by common tones, then by the number of differing notes.
+
+        :param notes: note names, pitch classes, MIDI numbers, or a pitch-class set
+        :param k: number of results
+        :param metric: "common" or "interval"
+        :return: list of (common tones or interval vector distance, Scale,
+            list of (root, mode) with that scale)
+        """
+        return cls.__nearest("scales", notes, k, metric)
 
-            if x[0] == 0 and x[1] == 3 and x[2] == 7 and x[3] == 11:
-                return root + " min(Maj7)"
+    @classmethod
+    def similar_chords(cls, notes, k=10, metric="common"):
+        """
+        Find the chords of every harmonization, from triads to 13th chords,
+        closest to a pitch-class set, ranked as by similar_scales.
+
+        :param notes: note names, pitch classes, MIDI numbers, or a pitch-class set
+        :param k: number of results
+        :param metric: "common" or "interval"
+        :return: list of (common tones or interval vector distance, Chord,
+            list of (root, mode, degree) where it appears)
+        """
+        return cls.__nearest("chords", notes, k, metric)
 
-            if x[0] == 3 and x[1] == 7 and x[2] == 11 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 3) % 12]
-                return root + "/" + drop + " min(Maj7)"
+    @classmethod
+    def note_index(cls, note):
+        """
+        :param note: note name in any spelling ("C#", "Db", "B##"), with or
+            without octave, or MIDI number
+        :return: pitch class of the note (0 for C ... 11 for B)
+        """
+        try:
+            return _PITCH_CLASSES[note]
+        except KeyError:
+            if isinstance(note, int):
+                return note % 12
+            raise ValueError("unknown note: %r" % (note,))
+        except TypeError:
+            raise ValueError("unknown note: %r" % (note,))
 
-            if x[0] == 7 and x[1] == 11 and x[2] == 0 and x[3] == 3:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 7) % 12]
-                return root + "/" + drop + " min(Maj7)"
+    def modes(self):
+        return self.__modes.keys()
 
-            if x[0] == 11 and x[1] == 0 and x[2] == 3 and x[3] == 7:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 11) % 12]
-                return root + "/" + drop + " min(Maj7)"
 
-            ########################## min7 ###########################
+def _rotate(mask, n):
+    """
+    Transpose a 12-bit pitch-class set up by n semitones.
 
-            if x[0] == 0 and x[1] == 3 and x[2] == 7 and x[3] == 10:
-                return root + " min7"
+    :param mask: pitch-class set
+    :param n: semitones
+    :return: transposed pitch-class set
+    """
+    n %= 12
+    return ((mask << n) | (mask >> (12 - n))) & 0xFFF
 
-            if x[0] == 3 and x[1] == 7 and x[2] == 10 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 3) % 12]
-                return root + "/" + drop + "min7"
 
-            if x[0] == 7 and x[1] == 10 and x[2] == 0 and x[3] == 3:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 7) % 12]
-                return root + "/" + drop + "min7"
+@functools.lru_cache(maxsize=None)
+def _set_tables():
+    """
+    Size and interval vector of every 12-bit pitch-class set. The count of
+    interval class d is the number of notes still in the set once it is
+    transposed by d, halved for the tritone which maps pairs both ways.
 
-            if x[0] == 10 and x[1] == 0 and x[2] == 3 and x[3] == 7:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 10) % 12]
-                return root + "/" + drop + "min7"
+    :return: (population counts, interval vectors) arrays indexed by set
+    """
+    masks = np.arange(4096)
 
-            ########################## min6 ###########################
+    popcount = np.zeros(4096, dtype=np.int16)
+    for i in range(12):
+        popcount += (masks >> i) & 1
 
-            if x[0] == 0 and x[1] == 3 and x[2] == 7 and x[3] == 9:
-                return root + " min6"
+    vectors = np.stack([popcount[masks & ((masks << d | masks >> (12 - d)) & 0xFFF)]
+                        for d in range(1, 7)], axis=1)
+    vectors[:, 5] //= 2
 
-            if x[0] == 3 and x[1] == 7 and x[2] == 9 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 3) % 12]
-                return root + "/" + drop + "min6"
+    return popcount, vectors
 
-            if x[0] == 7 and x[1] == 9 and x[2] == 0 and x[3] == 3:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 7) % 12]
-                return root + "/" + drop + "min6"
 
-            if x[0] == 9 and x[1] == 0 and x[2] == 3 and x[3] == 7:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 9) % 12]
-                return root + "/" + drop + "min6"
+def pitch_class_set(notes):
+    """
+    Encode notes as a 12-bit pitch-class set, bit i standing for pitch
+    class i (C = 0).
 
-            ########################## min7(b5) #######################
+    :param notes: note names, pitch classes or MIDI note numbers
+    :return: pitch-class set
+    """
+    mask = 0
+    for n in notes:
+        if isinstance(n, str):
+            n = Harmonizer.note_index(n)
+        mask |= 1 << (n % 12)
 
-            if x[0] == 0 and x[1] == 3 and x[2] == 6 and x[3] == 10:
-                return root + " min7(b5)"
+    return mask
 
-            if x[0] == 3 and x[1] == 6 and x[2] == 10 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 3) % 12]
-                return root + "/" + drop + " min7(b5)"
 
-            if x[0] == 6 and x[1] == 10 and x[2] == 0 and x[3] == 3:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 6) % 12]
-                return root + "/" + drop + " min7(b5)"
+class _PitchClassSet():
+    """
+    Immutable set of pitch classes with a distinguished root, stored as a
+    12-bit integer so that transposition is a rotation and containment or
+    common tones are bitwise ANDs.
+    """
 
-            if x[0] == 10 and x[1] == 0 and x[2] == 3 and x[3] == 6:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 10) % 12]
-                return root + "/" + drop + " min7(b5)"
+    __slots__ = ("root", "mask")
 
-            ########################## dim7 #######################
+    def __init__(self, root, mask):
+        self.root = root % 12
+        self.mask = mask & 0xFFF
 
-            if x[0] == 0 and x[1] == 3 and x[2] == 6 and x[3] == 9:
-                return root + " dim7"
+    @classmethod
+    def from_notes(cls, notes):
+        """
+        Build the set from a list of notes, the first one being the root.
 
-            if x[0] == 3 and x[1] == 6 and x[2] == 9 and x[3] == 0:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 3) % 12]
-                return root + "/" + drop + " dim7"
+        :param notes: note names, pitch classes or MIDI note numbers
+        :return: new instance
+        """
+        root = notes[0]
+        if isinstance(root, str):
+            root = Harmonizer.note_index(root)
 
-            if x[0] == 6 and x[1] == 9 and x[2] == 0 and x[3] == 3:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 6) % 12]
-                return root + "/" + drop + " dim7"
+        return cls(root, pitch_class_set(notes))
 
-            if x[0] == 9 and x[1] == 0 and x[2] == 3 and x[3] == 7:
-                root_idx = self.__notes.index(root)
-                drop = self.__notes[(root_idx + 9) % 12]
-                return root + "/" + drop + " dim7"
+    def intervals(self):
+        """
+        :return: semitones above the root of every pitch class, ascending
+        """
+        rel = _rotate(self.mask, -self.root)
+        return [i for i in range(12) if rel >> i & 1]
 
-        return "NA"
+    def notes(self):
+        """
+        :return: note names ascending from the root
+        """
+        return [_NOTES[(self.root + i) % 12] for i in self.intervals()]
 
-    def check_chord(self, root, x):
+    def interval_vector(self):
+        """
+        :return: number of note pairs at each interval class, from the
+            semitone to the tritone
         """
+        m = self.mask
+        vector = [(m & _rotate(m, d)).bit_count() for d in range(1, 7)]
+        vector[5] //= 2
 
-        :param root:
-        :param x:
-        :return:
+        return vector
+
+    def transpose(self, n):
         """
-        return self.__check_chord(root, x)
+        :param n: semitones
+        :return: the set transposed up by n semitones
+        """
+        return type(self)(self.root + n, _rotate(self.mask, n))
 
-    def harmonize(self):
+    def common_tones(self, other):
         """
+        :param other: pitch-class set or instance
+        :return: number of pitch classes shared with other
+        """
+        return (self.mask & getattr(other, "mask", other)).bit_count()
 
-        :return:
+    def __contains__(self, other):
+        if isinstance(other, str):
+            other = 1 << Harmonizer.note_index(other)
+        other = getattr(other, "mask", other)
+        return self.mask & other == other
+
+    def __len__(self):
+        return self.mask.bit_count()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.root == other.root and self.mask == other.mask
+
+    def __hash__(self):
+        return hash((type(self), self.root, self.mask))
+
+    def __repr__(self):
+        return "%s(%r, %s)" % (type(self).__name__, _NOTES[self.root], self.notes())
+
+
+class Scale(_PitchClassSet):
+    __slots__ = ()
+
+
+class Chord(_PitchClassSet):
+    __slots__ = ()
+
+    @property
+    def label(self):
+        """
+        :return: chord label, as given by Harmonizer.check_chord
         """
-        sc = self.get_scale()
-        sc = sc[:-1]
+        return Harmonizer.get().check_chord(_NOTES[self.root], self.intervals())
+
+
+class KeyDetector():
+    """
+    Sliding-window key and mode detection over a stream of notes.
+
+    Every distinct scale of every root and mode is scored by how many notes
+    of the window it contains. The scores live in fixed-width bit fields of
+    a single integer, so taking a note in or out of the window is one
+    addition or subtraction whatever the number of candidate scales. The
+    best score moves by at most one per note, and the fields reaching it
+    are found by adding a bias to every field at once and keeping their
+    top bits, so they are never decoded one by one. Among the best scales,
+    the mode whose tonic sounds most often wins.
+    """
+
+    __width = 16
+    __tables = None
+
+    def __init__(self, window=64):
+        if not 0 < window < 1 << (self.__width - 1):
+            raise ValueError("window must be between 1 and %d" % ((1 << (self.__width - 1)) - 1))
+
+        modes = len(Harmonizer.get().modes())
+        if KeyDetector.__tables is None or KeyDetector.__tables[0] != modes:
+            KeyDetector.__tables = (modes, self.__build_tables())
+        self.__masks, self.__tonics, self.__weights = KeyDetector.__tables[1]
+        ones = sum(1 << (self.__width * c) for c in range(len(self.__masks)))
+        self.__high = ones << (self.__width - 1)
+        self.__bias = [((1 << (self.__width - 1)) - s) * ones for s in range(window + 2)]
+
+        self.window = window
+        self.__notes = deque()
+        self.__counts = [0] * 12
+        self.__scores = 0
+        self.__best = 0
+        self.__last = (None, None)
+        self.__entries = None
+
+    @classmethod
+    def __build_tables(cls):
+        """
+        :return: candidate scale masks, their (tonic, (root, mode)) readings,
+            and the score increment of every pitch class
+        """
+        scales = {}
+        for root, mode in Harmonizer.find_modes(0):
+            s = Harmonizer.get(root=root, mode=mode).get_scale_set()
+            tonics = scales.setdefault(s.mask, {})
+            tonics.setdefault(s.root, (root, mode))
 
-        h = []
-        for i, x in enumerate(sc):
-            chrd = [sc[y] for y in [i, (i + 2) % len(sc), (i + 4) % len(sc), (i + 6) % len(sc)]]
-            root = chrd[0]
-            idx = [self.__notes.index(c) for c in chrd]
-            idx = [c if c >= 0 else (12 + c) for c in [(c - idx[0]) for c in idx]]
+        masks = list(scales)
+        tonics = [list(t.items()) for t in scales.values()]
+        weights = [sum(1 << (cls.__width * c) for c, m in enumerate(masks) if m >> pc & 1)
+                   for pc in range(12)]
 
-            h.append({ self.__check_chord(root, idx): chrd })
+        return masks, tonics, weights
 
-        return h
+    def push(self, note):
+        """
+        Add a note to the window, dropping the oldest one when it is full.
 
-    def modes(self):
-        return self.__modes.keys()
+        :param note: note name or MIDI note number
+        """
+        pc = Harmonizer.note_index(note) if isinstance(note, str) else note % 12
 
-    def modes(self):
-        return self.__modes.keys()
+        self.__notes.append(pc)
+        self.__counts[pc] += 1
+        self.__scores += self.__weights[pc]
 
+        if len(self.__notes) > self.window:
+            old = self.__notes.popleft()
+            self.__counts[old] -= 1
+            self.__scores -= self.__weights[old]
 
-if __name__ == "__main__":
-    h = Harmonizer(root="C", mode="harmonic minor")
+    def key(self):
+        """
+        :return: best (root, mode) for the current window, as accepted by
+            Harmonizer, or None if no note was pushed
+        """
+        scores = self.__scores
+        last_scores, last = self.__last
+        if scores == last_scores:
+            return last
+
+        if not self.__notes:
+            return None
+
+        # Adding 2^15 - s to every field sets the top bit of the fields
+        # scoring at least s; no field carries into the next one since
+        # scores stay below 2^15.
+        bias, high = self.__bias, self.__high
+        best = self.__best
+        fields = (scores + bias[best]) & high
+        if fields:
+            above = (scores + bias[best + 1]) & high
+            while above:
+                best += 1
+                fields = above
+                above = (scores + bias[best + 1]) & high
+        else:
+            while not fields:
+                best -= 1
+                fields = (scores + bias[best]) & high
+        self.__best = best
+
+        width = self.__width
+        counts = self.__counts
+        tonics = self.__tonics
+        key = None
+        key_count = -1
+        while fields:
+            bit = fields & -fields
+            fields ^= bit
+            for tonic, k in tonics[bit.bit_length() // width - 1]:
+                if counts[tonic] > key_count:
+                    key, key_count = k, counts[tonic]
+
+        self.__last = (scores, key)
+        return key
+
+    def __entry_tables(self):
+        """
+        :return: the (scale, tonic) readings in the order key() visits them,
+            as a (12, readings) matrix turning window counts into ranks, and
+            the list of their keys
+        """
+        if self.__entries is None:
+            columns, keys = [], []
+            for mask, readings in zip(self.__masks, self.__tonics):
+                for tonic, key in readings:
+                    # the scale score first, then the tonic count on ties
+                    columns.append([(mask >> pc & 1) * (self.window + 1) + (pc == tonic) for pc in range(12)])
+                    keys.append(key)
+            # single precision stays exact, and twice as fast, while ranks
+            # stay below 2^24
+            exact = (self.window + 1) ** 2 < 1 << 24
+            self.__entries = (np.array(columns, dtype=np.float32 if exact else np.float64).T.copy(), keys)
+
+        return self.__entries
+
+    def extend(self, notes, hop=1):
+        """
+        Add several notes at once, as repeated push calls would, and get
+        the key after every hop of them.
+
+        The window counts at each note are taken from running sums and the
+        scores of all scales from one matrix product, so a batch costs a few
+        array operations instead of a key() call per note.
+
+        :param notes: sequence of note names or MIDI note numbers
+        :param hop: take the key after every hop notes of the batch
+        :return: list of (root, mode), one per hop notes
+        """
+        pcs = np.asarray(notes)
+        if pcs.dtype.kind not in "iu":
+            pcs = np.array([Harmonizer.note_index(n) if isinstance(n, str) else n % 12 for n in notes],
+                           dtype=np.int64)
+        if not len(pcs):
+            return []
+        pcs = pcs.astype(np.int64) % 12
+
+        prev = np.array(self.__notes, dtype=np.int64)
+        full = np.concatenate((prev, pcs))
+        sums = np.zeros((len(full) + 1, 12), dtype=np.int32)
+        sums[np.arange(1, len(full) + 1), full] = 1
+        np.cumsum(sums, axis=0, out=sums)
+
+        ends = np.arange(len(prev) + hop, len(full) + 1, hop)
+        counts = sums[ends] - sums[np.maximum(ends - self.window, 0)]
+        keys = []
+        if len(ends):
+            ranks, readings = self.__entry_tables()
+            counts = counts.astype(ranks.dtype)
+            # among the best scales the reading with the most sounding tonic
+            # wins, the first one on ties, as in key()
+            keys = [readings[i] for i in (counts @ ranks).argmax(axis=1).tolist()]
+
+        kept = full[-self.window:].tolist()
+        self.__notes = deque(kept)
+        self.__counts = (sums[-1] - sums[len(full) - len(kept)]).tolist()
+        self.__scores = sum(c * w for c, w in zip(self.__counts, self.__weights))
+        self.__last = (self.__scores, keys[-1]) if keys and ends[-1] == len(full) else (None, None)
+
+        return keys
+
+
+def detect_keys(notes, window=64, hop=1):
+    """
+    Stream the running best-guess key of a note sequence.
+
+    Memory stays bounded by the window whatever the length of the input.
+
+    :param notes: iterable of note names or MIDI note numbers
+    :param window: number of most recent notes considered
+    :param hop: emit a guess every hop notes
+    :return: generator of (position, root, mode), position counting notes from 1
+    """
+    detector = KeyDetector(window=window)
+    notes = iter(notes)
+    size = hop * max(1, 4096 // hop)
+
+    i = 0
+    while True:
+        chunk = list(itertools.islice(notes, size))
+        if not chunk:
+            break
+        for root, mode in detector.extend(chunk, hop=hop):
+            i += hop
+            yield i, root, mode
+        i += len(chunk) % hop
+
+
+@functools.lru_cache(maxsize=None)
+def _voicing_table(rel):
+    """
+    Close-position voicings of a chord type, one per inversion.
+
+    :param rel: pitch-class set of the chord relative to its root
+    :return: tuple of ascending semitone offsets from the chord root
+    """
+    intervals = [i for i in range(12) if rel >> i & 1]
+    voicings = []
+    for k in range(len(intervals)):
+        v = intervals[k:] + [i + 12 for i in intervals[:k]]
+        voicings.append(tuple(v))
+
+    return tuple(voicings)
+
+
+@functools.lru_cache(maxsize=4096)
+def _voicing_candidates(root, mask, low, high):
+    """
+    Every close-position voicing of a chord within a MIDI note range.
+
+    :return: (n, k) array of MIDI note numbers, one voicing per row
+    """
+    rel = _rotate(mask, -root)
+    out = []
+    for v in _voicing_table(rel):
+        for base in range(low - low % 12 - 12 + root, high + 1, 12):
+            notes = [base + i for i in v]
+            if notes[0] >= low and notes[-1] <= high:
+                out.append(notes)
+
+    if not out:
+        raise ValueError("no voicing of %r fits between %d and %d" % (Chord(root, mask), low, high))
+
+    return np.array(out, dtype=np.int64)
+
+
+def _movement(a, b):
+    """
+    Voice movement between every voicing of a and every voicing of b: the
+    semitones travelled by paired voices when both have as many notes, or
+    the distance from each note to the nearest note of the other voicing.
+
+    :param a: (n, k) array of voicings
+    :param b: (m, l) array of voicings
+    :return: (n, m) cost matrix
+    """
+    if a.shape[1] == b.shape[1]:
+        return np.abs(a[:, None, :] - b[None, :, :]).sum(axis=2)
+
+    d = np.abs(a[:, None, :, None] - b[None, :, None, :])
+    return d.min(axis=3).sum(axis=2) + d.min(axis=2).sum(axis=2)
+
+
+def voice_lead(chords, low=48, high=84):
+    """
+    Choose a voicing (inversion and octave) for every chord of a progression
+    so that the total voice movement is minimal.
+
+    Dynamic programming over the close-position voicings of each chord:
+    the cost of a progression is linear in its length and quadratic only in
+    the handful of voicings per chord. The first chord prefers the middle
+    of the range.
+
+    :param chords: sequence of Chord, chord labels or note lists (root first)
+    :param low: lowest allowed MIDI note
+    :param high: highest allowed MIDI note
+    :return: (list of voicings as lists of MIDI notes, total movement in semitones)
+    """
+    candidates = []
+    for c in chords:
+        if isinstance(c, str):
+            c = Harmonizer.parse_chord(c)
+        elif not isinstance(c, _PitchClassSet):
+            c = Chord.from_notes(c)
+        candidates.append(_voicing_candidates(c.root, c.mask, low, high))
+
+    if not candidates:
+        return [], 0
+
+    cost = np.abs(candidates[0].mean(axis=1) - (low + high) / 2.0)
+    back = []
+    for prev, cur in zip(candidates, candidates[1:]):
+        total = cost[:, None] + _movement(prev, cur)
+        back.append(total.argmin(axis=0))
+        cost = total.min(axis=0)
+
+    best = int(cost.argmin())
+    path = [best]
+    for b in reversed(back):
+        best = int(b[best])
+        path.append(best)
+    path.reverse()
+
+    voicings = [c[i].tolist() for c, i in zip(candidates, path)]
+    movement = sum(int(_movement(np.array([a]), np.array([b]))[0, 0]) for a, b in zip(voicings, voicings[1:]))
+
+    return voicings, movement
+
+
+def segment_chords(events, coalesce=True):
+    """
+    Label the chord changes of a stream of note events.
+
+    The sounding notes are tracked incrementally and a label is produced
+    only when it differs from the previous one, so that octave moves of the
+    bass or changes between unrecognized sets are not reported.
+
+    :param events: iterable of (time, pitch, on) with pitch a MIDI note
+        number and on true for a note-on, false for a note-off, in time order
+    :param coalesce: wait for the time to move on before labelling, so that
+        the events of a same instant produce a single change; with False every
+        event is labelled as soon as it arrives, for the lowest latency
+    :return: generator of (time, label), label being "NA" for silence or an
+        unrecognized set
+    """
+    label_set = Harmonizer.label_set
+
+    sounding = [0] * 128
+    pcs = [0] * 12
+    mask = 0
+    bass = 128
+    last = "NA"
+    pending = None
+
+    for time, pitch, on in events:
+        if coalesce and pending is not None and time != pending:
+            label = label_set(mask, bass) if mask else "NA"
+            if label != last:
+                last = label
+                yield pending, label
+        pending = time
+
+        pc = pitch % 12
+
+        if on:
+            sounding[pitch] += 1
+            pcs[pc] += 1
+            mask |= 1 << pc
+            if pitch < bass:
+                bass = pitch
+        elif sounding[pitch]:
+            sounding[pitch] -= 1
+            pcs[pc] -= 1
+            if not pcs[pc]:
+                mask &= ~(1 << pc)
+            if pitch == bass and not sounding[pitch]:
+                while bass < 128 and not sounding[bass]:
+                    bass += 1
+        else:
+            continue
+
+        if not coalesce:
+            label = label_set(mask, bass) if mask else "NA"
+            if label != last:
+                last = label
+                yield time, label
+
+    if coalesce and pending is not None:
+        label = label_set(mask, bass) if mask else "NA"
+        if label != last:
+            yield pending, label
+
+
+# Fields of the note events decoded from a Standard MIDI File, exposed as
+# the MIDI_EVENT NumPy dtype.
+_MIDI_FIELDS = [("tick", "i8"), ("time", "f8"), ("track", "u2"), ("channel", "u1"),
+                ("pitch", "u1"), ("velocity", "u1"), ("on", "?")]
+
+
+def __getattr__(name):
+    # MIDI_EVENT is built on access so that importing does not import NumPy.
+    if name == "MIDI_EVENT":
+        return np.dtype(_MIDI_FIELDS)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def _read_track(data, pos, end, track, columns, tempos):
+    """
+    Decode the note events of one MTrk chunk into typed column buffers.
+
+    :param data: memoryview of the whole file
+    :param pos: offset of the first event
+    :param end: offset past the last event
+    :param track: track number
+    :param columns: (tick, track, channel, pitch, velocity, on) arrays to append to
+    :param tempos: list of (tick, microseconds per quarter) to append to
+    """
+    ticks, tracks, channels, pitches, velocities, ons = columns
+    tick = 0
+    status = 0
+
+    while pos < end:
+        delta = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            delta = (delta << 7) | (b & 0x7F)
+            if b < 0x80:
+                break
+        tick += delta
+
+        b = data[pos]
+        if b >= 0x80:
+            pos += 1
+            if b < 0xF0:
+                status = b
+        else:
+            b = status
+
+        kind = b & 0xF0
+        if kind == 0x90 or kind == 0x80:
+            velocity = data[pos + 1]
+            ticks.append(tick)
+            tracks.append(track)
+            channels.append(b & 0x0F)
+            pitches.append(data[pos])
+            velocities.append(velocity)
+            ons.append(kind == 0x90 and velocity > 0)
+            pos += 2
+        elif kind == 0xC0 or kind == 0xD0:
+            pos += 1
+        elif kind < 0xF0:
+            pos += 2
+        else:
+            if b == 0xFF:
+                meta = data[pos]
+                pos += 1
+            length = 0
+            while True:
+                c = data[pos]
+                pos += 1
+                length = (length << 7) | (c & 0x7F)
+                if c < 0x80:
+                    break
+            if b == 0xFF:
+                if meta == 0x51 and length == 3:
+                    tempos.append((tick, data[pos] << 16 | data[pos + 1] << 8 | data[pos + 2]))
+                elif meta == 0x2F:
+                    break
+            pos += length
+
+
+def read_midi(path):
+    """
+    Read the note events of a Standard MIDI File.
+
+    The file is memory-mapped and decoded straight into typed buffers, then
+    exposed as a NumPy structured array of MIDI_EVENT records without
+    building a Python object per event. Times are converted to seconds with
+    the tempo map; at equal times note-offs come before note-ons.
+
+    :param path: MIDI file path
+    :return: structured array of MIDI_EVENT
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < 14:
+            raise ValueError("not a MIDI file: %s" % path)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = memoryview(mm)
+            try:
+                if mm[:4] != b"MThd":
+                    raise ValueError("not a MIDI file: %s" % path)
+                header, _, ntracks, division = struct.unpack_from(">IHHH", data, 4)
+
+                columns = (array("q"), array("H"), array("B"), array("B"), array("B"), array("b"))
+                tempos = []
+
+                pos = 8 + header
+                track = 0
+                while pos + 8 <= size and track < ntracks:
+                    name = mm[pos:pos + 4]
+                    length, = struct.unpack_from(">I", data, pos + 4)
+                    start, pos = pos + 8, pos + 8 + length
+                    if pos > size:
+                        raise ValueError("truncated MIDI file: %s" % path)
+                    if name == b"MTrk":
+                        _read_track(data, start, pos, track, columns, tempos)
+                        track += 1
+                if track < ntracks and pos < size:
+                    raise ValueError("truncated MIDI file: %s" % path)
+            except IndexError:
+                raise ValueError("truncated MIDI file: %s" % path)
+            finally:
+                data.release()
+
+    events = np.empty(len(columns[0]), dtype=_MIDI_FIELDS)
+    for name, column in zip(("tick", "track", "channel", "pitch", "velocity", "on"), columns):
+        events[name] = np.frombuffer(column, dtype=column.typecode)
+    events = events[np.lexsort((events["on"], events["tick"]))]
+
+    if division & 0x8000:
+        fps = 256 - (division >> 8)
+        events["time"] = events["tick"] / float(fps * (division & 0xFF))
+    else:
+        tempos.sort()
+        change = np.array([0] + [t for t, _ in tempos], dtype=np.int64)
+        tempo = np.array([500000] + [u for _, u in tempos], dtype=np.float64)
+        seconds = np.concatenate(([0.0], np.cumsum(np.diff(change) * tempo[:-1]))) / (1e6 * division)
+        i = np.searchsorted(change, events["tick"], side="right") - 1
+        events["time"] = seconds[i] + (events["tick"] - change[i]) * tempo[i] / (1e6 * division)
+
+    return events
+
+
+def _pitched(events, drums):
+    """
+    :param events: MIDI file path or structured array from read_midi
+    :param drums: keep the events of the General MIDI percussion channel
+    :return: structured array of MIDI_EVENT
+    """
+    if isinstance(events, str):
+        events = read_midi(events)
+    if not drums:
+        events = events[events["channel"] != 9]
+
+    return events
+
+
+def midi_chords(events, coalesce=True, drums=False):
+    """
+    Label the chord changes of a MIDI file.
+
+    :param events: MIDI file path or structured array from read_midi
+    :param coalesce: see segment_chords
+    :param drums: also count the notes of channel 10, whose note numbers
+        select percussion sounds rather than pitches
+    :return: generator of (time in seconds, label)
+    """
+    events = _pitched(events, drums)
+
+    return segment_chords(zip(events["time"].tolist(), events["pitch"].tolist(), events["on"].tolist()),
+                          coalesce=coalesce)
+
+
+def midi_keys(events, window=64, hop=16, drums=False):
+    """
+    Stream the running key of a MIDI file over its note-ons.
+
+    :param events: MIDI file path or structured array from read_midi
+    :param window: number of most recent notes considered
+    :param hop: emit a guess every hop notes
+    :param drums: also count the notes of channel 10, see midi_chords
+    :return: generator of (time in seconds, root, mode)
+    """
+    events = _pitched(events, drums)
+
+    ons = events[events["on"]]
+    times = ons["time"]
+    for i, root, mode in detect_keys(ons["pitch"].tolist(), window=window, hop=hop):
+        yield float(times[i - 1]), root, mode
+
+
+def run_job(job):
+    """
+    Run a single batch job.
+
+    A job either names a root and mode, with op one of "scale", "intervals"
+    or "harmonize" (the default) and an optional harmonization depth, or carries a note sequence under "notes",
+    for which the key and the chord formed by the notes are detected.
+
+    :param job: job dict
+    :return: result dict
+    """
+    if job.get("notes") not in (None, ""):
+        notes = job["notes"]
+        if isinstance(notes, str):
+            notes = [int(n) if n.isdigit() else n for n in notes.split()]
+
+        detector = KeyDetector(window=min(max(len(notes), 1), 32767))
+        for n in notes:
+            detector.push(n)
+
+        return {"notes": job["notes"], "key": detector.key(), "chord": Harmonizer.name_chord(notes)}
+
+    h = Harmonizer.get(root=job.get("root") or "C", mode=job.get("mode") or "major")
+    op = job.get("op") or "harmonize"
+    if op == "scale":
+        result = h.get_scale()
+    elif op == "intervals":
+        result = h.get_intervals()
+    elif op == "harmonize":
+        result = h.harmonize(depth=int(job.get("depth") or 4))
+    else:
+        raise ValueError("unknown op: %r" % (op,))
+
+    return {"root": h.root, "mode": h.mode, "op": op, "result": result}
+
+
+def _run_chunk(lines, fieldnames):
+    """
+    Parse and run a chunk of input lines in a worker process.
+
+    :param lines: (line number, raw line) pairs
+    :param fieldnames: CSV header, or None for JSONL input
+    :return: list of JSON encoded results
+    """
+    out = []
+    for n, line in lines:
+        try:
+            if fieldnames is not None:
+                job = next(csv.DictReader([line], fieldnames=fieldnames))
+            else:
+                job = json.loads(line)
+            result = run_job(job)
+        except Exception as e:
+            result = {"error": "%s: %s" % (type(e).__name__, e)}
+        result["line"] = n
+        out.append(json.dumps(result))
+
+    return out
+
+
+def _chunks(f, size, start=1):
+    """
+    Split an input file into chunks of (line number, line) pairs, skipping
+    blank lines.
+
+    :param f: input file
+    :param size: lines per chunk
+    :param start: file line number of the next line read from f
+    """
+    chunk = []
+    for n, line in enumerate(f, start=start):
+        if not line.strip():
+            continue
+        chunk.append((n, line))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def run_batch(input_path, output_path, workers=None, chunksize=1000, ordered=True, fmt=None):
+    """
+    Run every job of a JSONL or CSV file over a process pool, writing one
+    JSON result per line.
+
+    Chunks are dispatched lazily with a bounded number in flight, so the
+    input is streamed rather than loaded in memory.
+
+    :param input_path: input file, "-" for stdin
+    :param output_path: output file, "-" for stdout
+    :param workers: number of worker processes, default one per CPU
+    :param chunksize: number of lines per dispatched chunk
+    :param ordered: write results in input order, or as soon as they are ready
+    :param fmt: "jsonl" or "csv", guessed from the input file extension by default
+    :return: number of jobs run
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+
+    if fmt is None:
+        fmt = "csv" if input_path.endswith(".csv") else "jsonl"
+
+    fin = sys.stdin if input_path == "-" else open(input_path, newline="")
+    fout = sys.stdout if output_path == "-" else open(output_path, "w")
+
+    try:
+        fieldnames = None
+        start = 1
+        if fmt == "csv":
+            fieldnames = next(csv.reader([fin.readline()]), None)
+            start = 2
+
+        workers = workers or os.cpu_count() or 1
+        count = 0
+
+        def flush(futures):
+            n = 0
+            for f in futures:
+                lines = f.result()
+                fout.write("\n".join(lines) + "\n")
+                n += len(lines)
+            return n
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque() if ordered else set()
+
+            for lines in _chunks(fin, chunksize, start=start):
+                if len(pending) >= 2 * workers:
+                    if ordered:
+                        count += flush([pending.popleft()])
+                    else:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        count += flush(done)
+
+                future = pool.submit(_run_chunk, lines, fieldnames)
+                if ordered:
+                    pending.append(future)
+                else:
+                    pending.add(future)
+
+            count += flush(pending if ordered else as_completed(pending))
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
+        if fout is not sys.stdout:
+            fout.close()
+
+    return count
+
+
+class HarmonyServer():
+    """
+    Minimal asyncio HTTP/1.1 server answering GET requests as JSON:
+
+    - /scale, /intervals, /harmonize with root and mode parameters
+    - /chord with root and intervals (comma separated) parameters, the
+      label keeping the spelling of the root
+    - /name with notes (comma separated MIDI note numbers) parameter
+    - /metrics in the Prometheus text format, or as JSON with format=json,
+      when metrics are enabled
+
+    Scale, intervals and harmonization responses are encoded once per root
+    and mode and then served from memory. Chord requests are queued and
+    labelled in micro-batches through Harmonizer.check_chords. Connections
+    beyond max_connections and chord requests beyond max_pending are turned
+    away with 503 so that latency stays bounded under overload.
+    """
+
+    __reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error",
+                 503: "Service Unavailable"}
+    __prometheus = b"text/plain; version=0.0.4"
+
+    def __init__(self, host="127.0.0.1", port=8765, max_connections=1024, max_pending=10000, max_batch=4096):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.max_batch = max_batch
+
+        self.__harmonizer = Harmonizer.get()
+        self.__responses = {}
+        self.__queue = asyncio.Queue(maxsize=max_pending)
+        self.__connections = 0
+        self.__server = None
+        self.__batcher = None
+
+    async def start(self):
+        """
+        Start listening and batching.
+        """
+        self.__server = await asyncio.start_server(self.__handle, self.host, self.port)
+        self.__batcher = asyncio.ensure_future(self.__batch_loop())
+        if self.port == 0:
+            self.port = self.__server.sockets[0].getsockname()[1]
 
-    m = h.modes()
-    s = h.get_scale()
+    async def close(self):
+        """
+        Stop listening and batching.
+        """
+        self.__server.close()
+        await self.__server.wait_closed()
+        self.__batcher.cancel()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.__server.serve_forever()
+        finally:
+            self.__batcher.cancel()
+
+    async def __batch_loop(self):
+        queue = self.__queue
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            # Pad voicings to a common width by doubling the bass, which
+            # leaves their pitch-class set and bass unchanged.
+            width = max(len(x) for _, x, _ in batch)
+            rows = [x + [x[0]] * (width - len(x)) for _, x, _ in batch]
+            try:
+                labels = self.__harmonizer.check_chords([r for r, _, _ in batch], rows)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, _, future), label in zip(batch, labels):
+                if not future.done():
+                    future.set_result(str(label))
+
+    async def __dispatch(self, target):
+        path, _, query = target.partition("?")
+        params = {k: v[-1] for k, v in parse_qs(query).items()}
+
+        if path in ("/scale", "/intervals", "/harmonize"):
+            key = (path, params.get("root", "C"), params.get("mode", "major"))
+            body = self.__responses.get(key)
+            if body is None:
+                h = Harmonizer.get(root=key[1], mode=key[2])
+                if path == "/scale":
+                    result = h.get_scale()
+                elif path == "/intervals":
+                    result = h.get_intervals()
+                else:
+                    result = h.harmonize()
+                body = self.__responses[key] = json.dumps({"result": result}).encode()
+            return 200, body
+
+        if path == "/chord":
+            # the root is labelled as spelled in the request, "C#" giving
+            # "C# Maj7" and "Db" giving "Db Maj7"; other note tokens such
+            # as MIDI numbers are spelled with flats
+            root = params.get("root", "C")
+            if root not in _SPELLINGS:
+                root = _NOTES[Harmonizer.note_index(root)]
+            intervals = [int(i) % 12 for i in params.get("intervals", "").split(",") if i]
+            if not intervals:
+                raise ValueError("missing intervals")
+
+            future = asyncio.get_running_loop().create_future()
+            try:
+                self.__queue.put_nowait((root, intervals, future))
+            except asyncio.QueueFull:
+                return 503, json.dumps({"error": "too many pending requests"}).encode()
+            try:
+                label = await future
+            except ValueError:
+                raise
+            except Exception:
+                return 500, json.dumps({"error": "chord labelling failed"}).encode()
+            return 200, json.dumps({"result": label}).encode()
+
+        if path == "/name":
+            notes = [int(n) for n in params.get("notes", "").split(",") if n]
+            return 200, json.dumps({"result": Harmonizer.name_chord(notes)}).encode()
+
+        if path == "/metrics":
+            metrics = Harmonizer.metrics()
+            if metrics is None:
+                return 404, json.dumps({"error": "metrics are disabled"}).encode()
+            if params.get("format") == "json":
+                return 200, metrics.to_json().encode()
+            return 200, metrics.to_prometheus().encode(), self.__prometheus
+
+        return 404, json.dumps({"error": "unknown path: %s" % path}).encode()
+
+    def __respond(self, writer, status, body, keep_alive, content_type=b"application/json"):
+        writer.write(b"HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n%s\r\n"
+                     % (status, self.__reasons[status].encode(), content_type, len(body),
+                        b"" if keep_alive else b"Connection: close\r\n") + body)
+
+    async def __handle(self, reader, writer):
+        if self.__connections >= self.max_connections:
+            self.__respond(writer, 503, b'{"error": "too many connections"}', False)
+            writer.close()
+            return
+
+        self.__connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+
+                keep_alive = not line.rstrip().endswith(b"HTTP/1.0")
+                length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode("latin-1").partition(":")
+                    name = name.strip().lower()
+                    if name == "content-length":
+                        try:
+                            length = int(value)
+                        except ValueError:
+                            length = -1
+                    elif name == "connection":
+                        keep_alive = value.strip().lower() == "keep-alive"
+                if length < 0:
+                    # the body cannot be framed, so the connection cannot be reused
+                    self.__respond(writer, 400, b'{"error": "invalid Content-Length"}', False)
+                    await writer.drain()
+                    break
+                if length:
+                    await reader.readexactly(length)
+
+                parts = line.decode("latin-1").split()
+                if len(parts) < 2 or parts[0] != "GET":
+                    response = 400, b'{"error": "only GET is supported"}'
+                else:
+                    try:
+                        response = await self.__dispatch(parts[1])
+                    except ValueError as e:
+                        response = 400, json.dumps({"error": str(e) or "invalid parameters"}).encode()
+
+                status, body, *content_type = response
+                self.__respond(writer, status, body, keep_alive, *content_type)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.__connections -= 1
+            writer.close()
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="harmony", description="Scales, modes and chord harmonization.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("harmonize", help="harmonize a single root and mode")
+    p.add_argument("--root", default="C")
+    p.add_argument("--mode", default="major")
+    p.add_argument("--op", default="harmonize", choices=["scale", "intervals", "harmonize"])
+    p.add_argument("--depth", type=int, default=4, help="notes per harmonized chord, 3 to 7")
+
+    p = sub.add_parser("batch", help="run a JSONL or CSV file of jobs over a process pool")
+    p.add_argument("input", help="input file, - for stdin")
+    p.add_argument("-o", "--output", default="-", help="output JSONL file, - for stdout")
+    p.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    p.add_argument("--chunksize", type=int, default=1000, help="lines per dispatched chunk")
+    p.add_argument("--unordered", action="store_true", help="write results as soon as they are ready")
+    p.add_argument("--format", choices=["jsonl", "csv"], default=None, help="input format (default: from extension)")
+
+    p = sub.add_parser("serve", help="serve scales, harmonizations and chord labels over HTTP")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--max-connections", type=int, default=1024, help="concurrent connections before 503")
+    p.add_argument("--max-pending", type=int, default=10000, help="queued chord requests before 503")
+    p.add_argument("--metrics", action="store_true", help="record metrics and serve them on /metrics")
+
+    p = sub.add_parser("tables", help="write the lookup tables file to map with HARMONY_TABLES")
+    p.add_argument("output", help="output file")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "tables":
+        Harmonizer.save_tables(args.output)
+        return 0
+
+    if args.command == "serve":
+        if args.metrics:
+            Harmonizer.enable_metrics()
+        server = HarmonyServer(host=args.host, port=args.port, max_connections=args.max_connections,
+                               max_pending=args.max_pending)
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.command == "harmonize":
+        print(json.dumps(run_job({"root": args.root, "mode": args.mode, "op": args.op, "depth": args.depth})))
+        return 0
+
+    t = time.perf_counter()
+    count = run_batch(args.input, args.output, workers=args.workers, chunksize=args.chunksize,
+                      ordered=not args.unordered, fmt=args.format)
+    elapsed = time.perf_counter() - t
+    print("%d jobs in %.2f s (%.0f jobs/s)" % (count, elapsed, count / elapsed if elapsed else 0.0),
+          file=sys.stderr)
+    return 0
+
+
+# Process-wide setup from the environment, once everything above is defined.
+if os.environ.get("HARMONY_METRICS"):
+    Harmonizer.enable_metrics()
+
+if os.environ.get("HARMONY_TABLES"):
+    Harmonizer.load_tables(os.environ["HARMONY_TABLES"])
+
+if os.environ.get("HARMONY_CACHE_FILE"):
+    Harmonizer.load_cache(os.environ["HARMONY_CACHE_FILE"])
+elif os.environ.get("HARMONY_WARM_CACHE"):
+    Harmonizer.warm_cache()
 
-    hh = h.harmonize()
-    print(hh)
 
+if __name__ == "__main__":
+    sys.exit(main())
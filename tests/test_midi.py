@@ -0,0 +1,105 @@
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import harmony
+
+
+def vlq(n):
+    out = [n & 0x7F]
+    n >>= 7
+    while n:
+        out.append(0x80 | (n & 0x7F))
+        n >>= 7
+    return bytes(reversed(out))
+
+
+def track(events):
+    body = b"".join(vlq(delta) + event for delta, event in events) + b"\x00\xff\x2f\x00"
+    return b"MTrk" + struct.pack(">I", len(body)) + body
+
+
+def midi(tracks, division=480):
+    return b"MThd" + struct.pack(">IHHH", 6, 1, len(tracks), division) + b"".join(tracks)
+
+
+# Tempo map: 120 bpm, then 240 bpm from tick 960.
+TEMPO = track([(0, b"\xff\x51\x03\x07\xa1\x20"), (960, b"\xff\x51\x03\x03\xd0\x90")])
+
+NOTES = track([
+    # C Maj7 in running status, a sysex and an escaped sysex in between
+    (0, b"\x90\x3c\x64"), (0, b"\x40\x64"), (0, b"\x43\x64"),
+    (0, b"\xf0\x03\x7e\x09\xf7"), (0, b"\xf7\x02\x01\x02"), (0, b"\x90\x47\x64"),
+    # released with zero-velocity note-ons, then G7 released with note-offs
+    (480, b"\x90\x3c\x00"), (0, b"\x40\x00"), (0, b"\x43\x00"), (0, b"\x47\x00"),
+    (0, b"\x90\x37\x50"), (0, b"\x3b\x50"), (0, b"\x3e\x50"), (0, b"\x41\x50"), (0, b"\xc0\x05"),
+    (480, b"\x80\x37\x00"), (0, b"\x3b\x00"), (0, b"\x3e\x00"), (0, b"\x41\x00"),
+    # F Maj on channel 2 after the tempo change
+    (0, b"\x91\x35\x50"), (0, b"\x39\x50"), (0, b"\x3c\x50"),
+    (480, b"\x81\x35\x00"), (0, b"\x39\x00"), (0, b"\x3c\x00"),
+])
+
+DRUMS = track([(0, b"\x99\x24\x64"), (0, b"\x2a\x64"), (0, b"\x2e\x64"),
+               (480, b"\x89\x24\x00"), (0, b"\x2a\x00"), (0, b"\x2e\x00")])
+
+
+class MidiTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, data):
+        path = os.path.join(self.dir.name, "%d.mid" % len(os.listdir(self.dir.name)))
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_events(self):
+        events = harmony.read_midi(self.write(midi([TEMPO, NOTES])))
+        on = events[events["on"]]
+
+        self.assertEqual(len(events), 22)
+        self.assertEqual(on["pitch"].tolist(), [60, 64, 67, 71, 55, 59, 62, 65, 53, 57, 60])
+        self.assertEqual(sorted(set(on["channel"].tolist())), [0, 1])
+        self.assertEqual(sorted(set(on["time"].tolist())), [0.0, 0.5, 1.0])
+        self.assertEqual(events["time"].max(), 1.25)
+
+    def test_chords(self):
+        path = self.write(midi([TEMPO, NOTES, DRUMS]))
+
+        self.assertEqual(list(harmony.midi_chords(path)), [(0.0, "C Maj7"), (0.5, "G 7"), (1.0, "F Maj"), (1.25, "NA")])
+        self.assertNotEqual(list(harmony.midi_chords(path, drums=True))[0], (0.0, "C Maj7"))
+
+    def test_keys(self):
+        path = self.write(midi([TEMPO, NOTES, DRUMS]))
+
+        self.assertEqual(list(harmony.midi_keys(path, window=11, hop=11)),
+                         list(harmony.midi_keys(self.write(midi([TEMPO, NOTES])), window=11, hop=11)))
+        self.assertEqual(len(list(harmony.midi_keys(path, window=11, hop=1, drums=True))), 14)
+
+    def test_smpte(self):
+        # 25 frames per second, 40 ticks per frame: one tick per millisecond
+        events = harmony.read_midi(self.write(midi([TEMPO, NOTES], division=0xE728)))
+
+        self.assertEqual(events["time"].tolist(), (events["tick"] / 1000.0).tolist())
+
+    def test_truncated(self):
+        data = midi([TEMPO, NOTES])
+        for size in (20, len(data) - 10, len(data) - 1):
+            with self.assertRaises(ValueError):
+                harmony.read_midi(self.write(data[:size]))
+
+    def test_not_midi(self):
+        with self.assertRaises(ValueError):
+            harmony.read_midi(self.write(b"RIFF" + bytes(20)))
+
+
+if __name__ == "__main__":
+    unittest.main()